@@ -0,0 +1,241 @@
+import os
+import sys
+import time
+import json
+import argparse
+import asyncio
+import tempfile
+import resource
+import subprocess
+import tracemalloc
+from fake_backends import FakeTelegram, FakeOpenAI, start_server
+
+# Offline benchmark: drives the real handlers of bot/gpt_telegram_bot.py against the fake Telegram and OpenAI backends.
+# Usage: python bench/benchmark.py --scenario all --users 20 --requests 100 --audio-lengths 30,600
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot")
+BENCH_TOKEN = "123456:BENCHMARK"
+WHITELISTED_USER_OFFSET = 100000
+BLACKLISTED_USER_OFFSET = 900000
+
+def get_args() -> object:
+    parser = argparse.ArgumentParser(description="Offline benchmark of the STT ChatGPT Telegram bot.")
+    parser.add_argument("--scenario", choices=["text", "audio", "video", "guard", "all"], default="all")
+    parser.add_argument("--users", type=int, default=10, help="concurrent users")
+    parser.add_argument("--requests", type=int, default=50, help="requests per scenario (and audio length)")
+    parser.add_argument("--audio-lengths", default="30,300", help="comma separated lengths of the synthetic audio in seconds")
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument("--openai-latency", type=float, default=0.3)
+    parser.add_argument("--token-latency", type=float, default=0.02)
+    parser.add_argument("--whisper-realtime-factor", type=float, default=0.02)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    return parser.parse_args()
+
+def generate_audio(path: str, seconds: int) -> str:
+    # speech-like test signal: one second tone bursts separated by pauses of growing length
+    expression = "0.5*sin(220*2*PI*t)*lt(mod(t\\,7)\\,4)"
+    subprocess.run([
+        "ffmpeg", "-y", "-loglevel", "error", "-f", "lavfi", "-i", f"aevalsrc={expression}:s=16000:d={seconds}",
+        "-ac", "1", "-c:a", "libopus", "-b:a", "32k", path
+    ], check=True)
+    return path
+
+def get_percentile(values: list, percentile: float) -> float:
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percentile / 100 * (len(values) - 1))))
+    return values[index]
+
+def get_summary(name: str, latencies: list, errors: int, wall_time: float) -> dict:
+    return {
+        "scenario": name,
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "throughput_per_s": round(len(latencies) / wall_time, 2) if wall_time > 0 else 0.0,
+        "p50_s": round(get_percentile(latencies, 50), 4),
+        "p99_s": round(get_percentile(latencies, 99), 4),
+        "max_s": round(max(latencies), 4) if len(latencies) > 0 else 0.0,
+    }
+
+def get_text_update(bot_module: object, bot: object, update_id: int, user_id: int, text: str) -> object:
+    return bot_module.Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": int(time.time()), "text": text,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"}
+        }
+    }, bot)
+
+def get_media_update(bot_module: object, bot: object, update_id: int, user_id: int, file_id: str, seconds: int, media_type: str = "voice") -> object:
+    if media_type == "video":
+        # like most videos sent to Telegram, without a file_name
+        media = {"file_id": file_id, "file_unique_id": file_id, "width": 640, "height": 360, "duration": seconds, "mime_type": "video/mp4"}
+    else:
+        media = {"file_id": file_id, "file_unique_id": file_id, "duration": seconds, "mime_type": "audio/ogg"}
+    return bot_module.Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+            media_type: media
+        }
+    }, bot)
+
+async def run_concurrently(users: int, requests: int, run_request: object) -> []:
+    # returns [latencies, errors, wall time]
+    semaphore = asyncio.Semaphore(users)
+    latencies = []
+    errors = 0
+
+    async def run_one(index: int) -> None:
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await run_request(index)
+                latencies.append(time.perf_counter() - start)
+            except Exception as e:
+                errors += 1
+                print(f"request {index} failed: {e!r}", file=sys.stderr)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[run_one(index) for index in range(requests)])
+    return [latencies, errors, time.perf_counter() - start]
+
+async def main(args: object) -> []:
+    work_dir = tempfile.mkdtemp(prefix="sttbot_bench_")
+    os.chdir(work_dir) # settings, cache and queue databases of the bot are created here
+    telegram = FakeTelegram(args.telegram_latency)
+    openai_backend = FakeOpenAI(args.openai_latency, args.token_latency, args.whisper_realtime_factor)
+    telegram_runner, telegram_url = await start_server(telegram.get_app())
+    openai_runner, openai_url = await start_server(openai_backend.get_app())
+
+    os.environ.update({"TELEGRAM_BOT_KEY": BENCH_TOKEN, "TELEGRAM_BOT_PW": "benchmark", "OPENAI_API_KEY": "sk-benchmark"})
+    os.environ.setdefault("MEDIA_JOB_WORKERS", str(args.users))
+    sys.path.insert(0, os.path.abspath(BOT_DIR))
+    import openai
+    import chat_context
+    import gpt_telegram_bot as bot_module
+    from telegram.ext import ApplicationBuilder
+    openai.api_base = openai_url + "/v1"
+    bot_module.setup_bot_logging()
+    if os.environ.get("TIKTOKEN_CACHE_DIR") == None:
+        chat_context.tiktoken = None # tiktoken downloads its encodings, so the token count falls back to the estimate
+
+    application = (
+        ApplicationBuilder()
+        .token(BENCH_TOKEN)
+        .base_url(telegram_url + "/bot")
+        .base_file_url(telegram_url + "/file/bot")
+        .concurrent_updates(True)
+        .rate_limiter(bot_module.ChatRateLimiter())
+        .http_version("1.1") # the fake backends speak HTTP/1.1 only
+        .get_updates_http_version("1.1")
+        .build()
+    )
+    bot_module.register_handlers(application)
+    failed_update_ids = set()
+
+    async def record_error(update: object, context: object) -> None:
+        # the bot reports handler errors to the user instead of raising them, so they are counted here
+        if isinstance(update, bot_module.Update):
+            failed_update_ids.add(update.update_id)
+    application.add_error_handler(record_error)
+
+    async def process_update(update: object) -> None:
+        await application.process_update(update)
+        if update.update_id in failed_update_ids:
+            raise RuntimeError(f"update {update.update_id} was handled by the error handler")
+
+    await application.initialize()
+    await bot_module.startup(application)
+    for user_id in range(WHITELISTED_USER_OFFSET, WHITELISTED_USER_OFFSET + max(args.users, args.requests)):
+        bot_module.settings.add_whitelisted_id(user_id)
+    for user_id in range(BLACKLISTED_USER_OFFSET, BLACKLISTED_USER_OFFSET + args.users):
+        bot_module.settings.add_blacklisted_id(user_id)
+
+    update_ids = iter(range(1, 10 ** 9))
+    results = []
+    tracemalloc.start()
+    try:
+        if args.scenario in ["text", "all"]:
+            async def run_text(index: int) -> None:
+                user_id = WHITELISTED_USER_OFFSET + index % args.users
+                update = get_text_update(bot_module, application.bot, next(update_ids), user_id, f"Benchmark question {index}")
+                await process_update(update)
+            completions_before = openai_backend.request_counts.get("chat_completions", 0)
+            summary = get_summary("text", *(await run_concurrently(args.users, args.requests, run_text)))
+            # every answered question needs at least one completion
+            completions = openai_backend.request_counts.get("chat_completions", 0) - completions_before
+            if completions < args.requests - summary["errors"]:
+                print(f"text: expected at least {args.requests - summary['errors']} chat completions, got {completions}", file=sys.stderr)
+                summary["errors"] = args.requests - completions
+            results.append(summary)
+
+        if args.scenario in ["guard", "all"]:
+            async def run_guard(index: int) -> None:
+                user_id = BLACKLISTED_USER_OFFSET + index % args.users
+                update = get_text_update(bot_module, application.bot, next(update_ids), user_id, "Let me in")
+                await process_update(update)
+            results.append(get_summary("guard", *(await run_concurrently(args.users, args.requests, run_guard))))
+
+        media_types = {"audio": ["voice"], "video": ["video"], "all": ["voice", "video"]}.get(args.scenario, [])
+        for seconds in [int(length) for length in args.audio_lengths.split(",")] if len(media_types) > 0 else []:
+            audio_file = generate_audio(os.path.join(work_dir, f"synthetic_{seconds}s.ogg"), seconds)
+            for media_type in media_types:
+                name = f"{'audio' if media_type == 'voice' else media_type}_{seconds}s"
+
+                async def run_audio(index: int) -> None:
+                    # every request uses its own chat and file id, so neither the cache nor the chat state is shared
+                    update_id = next(update_ids)
+                    file_id = f"bench-{name}-{update_id}"
+                    telegram.files[file_id] = audio_file
+                    user_id = WHITELISTED_USER_OFFSET + index # one chat per request, so the transcript can be matched to it
+                    update = get_media_update(bot_module, application.bot, update_id, user_id, file_id, seconds, media_type)
+                    transcript_received = telegram.wait_for_transcript(user_id)
+                    await process_update(update)
+                    await asyncio.wait_for(transcript_received.wait(), timeout=600)
+
+                uploads_before = openai_backend.request_counts.get("audio_transcriptions", 0)
+                summary = get_summary(name, *(await run_concurrently(args.users, args.requests, run_audio)))
+                # a file that fits into one Whisper segment must be uploaded exactly once
+                uploads = openai_backend.request_counts.get("audio_transcriptions", 0) - uploads_before
+                output_seconds = seconds / bot_module.settings.speed
+                if output_seconds <= bot_module.plan_encoding(output_seconds)["segment_time"] and uploads != args.requests:
+                    print(f"{name}: expected {args.requests} Whisper uploads (one segment per file), got {uploads}", file=sys.stderr)
+                    summary["errors"] += args.requests
+                results.append(summary)
+    finally:
+        memory_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        await bot_module.shutdown(application)
+        await application.shutdown()
+        await telegram_runner.cleanup()
+        await openai_runner.cleanup()
+
+    memory = {
+        "python_peak_mb": round(memory_peak / (1024 * 1024), 2),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2),
+        "telegram_requests": telegram.request_counts,
+        "openai_requests": openai_backend.request_counts,
+    }
+    return [results, memory]
+
+def print_results(results: list, memory: dict) -> None:
+    print(f"{'scenario':<16}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 [s]':>10}{'p99 [s]':>10}{'max [s]':>10}")
+    for result in results:
+        print(f"{result['scenario']:<16}{result['requests']:>10}{result['errors']:>8}{result['throughput_per_s']:>10}{result['p50_s']:>10}{result['p99_s']:>10}{result['max_s']:>10}")
+    print(f"Python heap peak: {memory['python_peak_mb']} MB, max RSS: {memory['max_rss_mb']} MB")
+    print(f"Telegram API calls: {memory['telegram_requests']}")
+    print(f"OpenAI API calls: {memory['openai_requests']}")
+
+
+if __name__ == "__main__":
+    args = get_args()
+    results, memory = asyncio.run(main(args))
+    if args.json:
+        print(json.dumps({"results": results, "memory": memory}, indent=2))
+    else:
+        print_results(results, memory)
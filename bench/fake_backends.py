@@ -0,0 +1,132 @@
+import json
+import time
+import asyncio
+import itertools
+from aiohttp import web
+
+# Local stand-ins for the Telegram Bot API and the OpenAI API with configurable latency.
+FAKE_TRANSCRIPT = "FAKE TRANSCRIPT"
+FAKE_REPLY_WORDS = ["This", "is", "a", "fake", "ChatGPT", "reply", "from", "the", "benchmark", "backend."]
+
+class FakeTelegram:
+    def __init__(self, latency: float = 0.05):
+        self.latency = latency
+        self.files = {} # file_id -> local path of the synthetic media
+        self.request_counts = {}
+        self.waiters = {} # chat_id -> asyncio.Event, set when a transcript reaches the chat
+        self._message_ids = itertools.count(1000)
+
+    def get_app(self) -> web.Application:
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_route("*", "/bot{token}/{method}", self.handle_method)
+        app.router.add_get("/file/bot{token}/{file_path:.*}", self.handle_file)
+        return app
+
+    def wait_for_transcript(self, chat_id: int) -> asyncio.Event:
+        self.waiters[chat_id] = asyncio.Event()
+        return self.waiters[chat_id]
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.request_counts[method] = self.request_counts.get(method, 0) + 1
+        params = await self._get_params(request)
+        await asyncio.sleep(self.latency)
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"}
+        elif method in ["sendMessage", "editMessageText"]:
+            chat_id = int(params["chat_id"])
+            text = params.get("text", "")
+            if FAKE_TRANSCRIPT in text and chat_id in self.waiters:
+                self.waiters.pop(chat_id).set()
+            message_id = int(params["message_id"]) if "message_id" in params else next(self._message_ids)
+            result = {"message_id": message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, "text": text}
+        elif method == "sendDocument":
+            chat_id = int(params["chat_id"])
+            if chat_id in self.waiters:
+                self.waiters.pop(chat_id).set()
+            result = {"message_id": next(self._message_ids), "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}}
+        elif method == "getFile":
+            file_id = params["file_id"]
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_path": f"media/{file_id}"}
+        else: # deleteMessage, sendChatAction, ...
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle_file(self, request: web.Request) -> web.StreamResponse:
+        file_id = request.match_info["file_path"].split("/")[-1]
+        await asyncio.sleep(self.latency)
+        return web.FileResponse(self.files[file_id])
+
+    async def _get_params(self, request: web.Request) -> dict:
+        if request.content_type == "application/json":
+            return await request.json()
+        params = dict(request.query)
+        if request.can_read_body:
+            form = await request.post()
+            for key, value in form.items():
+                params[key] = value if isinstance(value, str) else "<file>"
+        return params
+
+
+class FakeOpenAI:
+    def __init__(self, latency: float = 0.5, token_latency: float = 0.02, whisper_realtime_factor: float = 0.02):
+        self.latency = latency # base latency of every request
+        self.token_latency = token_latency # delay between two streamed tokens
+        self.whisper_realtime_factor = whisper_realtime_factor # seconds of latency per second of uploaded audio
+        self.request_counts = {}
+
+    def get_app(self) -> web.Application:
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_post("/v1/chat/completions", self.handle_chat_completion)
+        app.router.add_post("/v1/audio/transcriptions", self.handle_transcription)
+        return app
+
+    def _count(self, name: str) -> None:
+        self.request_counts[name] = self.request_counts.get(name, 0) + 1
+
+    async def handle_chat_completion(self, request: web.Request) -> web.StreamResponse:
+        self._count("chat_completions")
+        body = await request.json()
+        await asyncio.sleep(self.latency)
+        if not body.get("stream"):
+            await asyncio.sleep(self.token_latency * len(FAKE_REPLY_WORDS))
+            return web.json_response({
+                "id": "chatcmpl-bench", "object": "chat.completion", "created": int(time.time()), "model": body["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(FAKE_REPLY_WORDS)}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 10 * len(body["messages"]), "completion_tokens": len(FAKE_REPLY_WORDS), "total_tokens": 10 * len(body["messages"]) + len(FAKE_REPLY_WORDS)}
+            })
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for word in FAKE_REPLY_WORDS:
+            chunk = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": int(time.time()), "model": body["model"],
+                     "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(self.token_latency)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def handle_transcription(self, request: web.Request) -> web.Response:
+        self._count("audio_transcriptions")
+        reader = await request.multipart()
+        size = 0
+        async for part in reader:
+            if part.name == "file":
+                while True:
+                    chunk = await part.read_chunk()
+                    if not chunk:
+                        break
+                    size += len(chunk)
+        duration = size * 8 / 24000 # roughly the bitrate of the planned speech encoding
+        await asyncio.sleep(self.latency + duration * self.whisper_realtime_factor)
+        return web.json_response({"task": "transcribe", "language": "english", "duration": duration, "text": FAKE_TRANSCRIPT, "segments": []})
+
+
+async def start_server(app: web.Application) -> []:
+    # returns [runner, base url]
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return [runner, f"http://127.0.0.1:{port}"]
@@ -0,0 +1,106 @@
+import os
+import sys
+import time
+import json
+import random
+import argparse
+
+# Micro-benchmark of split_text_fit_message on multi-megabyte synthetic transcripts.
+# Usage: python bench/split_benchmark.py --sizes 1,5 --repeat 3
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot")
+sys.path.insert(0, os.path.abspath(BOT_DIR))
+from message_splitter import split_text_fit_message, get_utf16_length, TELEGRAM_MESSAGE_LIMIT
+
+WORDS = {
+    "latin": ["the", "transcription", "of", "a", "long", "meeting", "about", "budget", "planning", "and", "next", "steps"],
+    "emoji": ["great", "👍", "idea", "🎉", "we", "ship", "it", "🚀", "today", "👍🏽", "ok", "👨‍👩‍👧"],
+    "cjk": ["会議", "の", "議事録", "です", "予算", "について", "話しました", "次", "の", "ステップ", "確認", "します"],
+}
+SENTENCE_ENDS = {"latin": [". ", "? ", "! "], "emoji": [". ", "! "], "cjk": ["。", "？", "！"]}
+
+def get_args() -> object:
+    parser = argparse.ArgumentParser(description="Micro-benchmark of the Telegram message splitter.")
+    parser.add_argument("--sizes", default="1,5", help="comma separated transcript sizes in MB")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per input, the fastest one is reported")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    return parser.parse_args()
+
+def generate_text(kind: str, size: int, markup: str = None) -> str:
+    # sentences of 5-25 words, a paragraph break every 3-8 sentences
+    rng = random.Random(size)
+    words = WORDS[kind]
+    separator = "" if kind == "cjk" else " "
+    parts = []
+    total = 0
+    while total < size:
+        paragraph = []
+        for i in range(rng.randint(3, 8)):
+            sentence = separator.join([rng.choice(words) for j in range(rng.randint(5, 25))])
+            if markup == "HTML" and rng.random() < 0.2:
+                sentence = f"<b>{sentence}</b>"
+            elif markup == "MarkdownV2" and rng.random() < 0.2:
+                sentence = f"*{sentence}*"
+            paragraph.append(sentence + rng.choice(SENTENCE_ENDS[kind]))
+        parts.append("".join(paragraph).strip())
+        total += len(parts[-1].encode("utf-8")) + 2
+    return "\n\n".join(parts)
+
+def legacy_split(input_text: str) -> []:
+    # the previous implementation: Python characters, "." only
+    length = len(input_text)
+    segments = []
+    start_index = 0
+    while start_index < length:
+        end_index = input_text.rfind(".", start_index, start_index + 4095)
+        if start_index + 4095 >= length:
+            segments.append(input_text[start_index:])
+            break
+        elif end_index == -1:
+            end_index = start_index + 4095
+        segments.append(input_text[start_index:end_index+1])
+        start_index = end_index + 1
+    return segments
+
+def run_case(name: str, split: object, text: str, repeat: int) -> dict:
+    best = None
+    for i in range(repeat):
+        started = time.perf_counter()
+        segments = split(text)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best == None else min(best, elapsed)
+    size_mb = len(text.encode("utf-8")) / (1024 * 1024)
+    return {
+        "case": name,
+        "size_mb": round(size_mb, 2),
+        "segments": len(segments),
+        "seconds": round(best, 4),
+        "mb_per_s": round(size_mb / best, 1),
+        "too_long": len([segment for segment in segments if get_utf16_length(segment) > TELEGRAM_MESSAGE_LIMIT]),
+    }
+
+def main(args: object) -> []:
+    results = []
+    for size_mb in [float(size) for size in args.sizes.split(",")]:
+        size = int(size_mb * 1024 * 1024)
+        for kind in WORDS.keys():
+            text = generate_text(kind, size)
+            results.append(run_case(f"legacy_{kind}", legacy_split, text, args.repeat))
+            results.append(run_case(f"plain_{kind}", split_text_fit_message, text, args.repeat))
+        for parse_mode in ["HTML", "MarkdownV2"]:
+            text = generate_text("latin", size, parse_mode)
+            results.append(run_case(f"{parse_mode.lower()}_latin", lambda text: split_text_fit_message(text, parse_mode=parse_mode), text, args.repeat))
+    return results
+
+def print_results(results: list) -> None:
+    print(f"{'case':<18}{'MB':>8}{'segments':>10}{'seconds':>10}{'MB/s':>8}{'too long':>10}")
+    for result in results:
+        print(f"{result['case']:<18}{result['size_mb']:>8}{result['segments']:>10}{result['seconds']:>10}{result['mb_per_s']:>8}{result['too_long']:>10}")
+
+
+if __name__ == "__main__":
+    args = get_args()
+    results = main(args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
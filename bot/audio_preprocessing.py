@@ -0,0 +1,100 @@
+import os
+import re
+import asyncio
+import ffmpeg
+
+# Silence trimming and pause-aligned chunking before the Whisper upload.
+# A first ffmpeg pass finds the pauses with silencedetect. Pauses of at least SILENCE_MIN_CUT_DURATION seconds are cut
+# down to 2 * SILENCE_PADDING seconds, and chunk boundaries are moved to the nearest pause before the segment time.
+SILENCE_TRIMMING = os.environ.get("SILENCE_TRIMMING", "true").lower() in ["1", "true", "yes"]
+SILENCE_THRESHOLD_DB = float(os.environ.get("SILENCE_THRESHOLD_DB", -35))
+SILENCE_MIN_PAUSE_DURATION = 0.3 # shortest pause that is used as chunk boundary
+SILENCE_MIN_CUT_DURATION = float(os.environ.get("SILENCE_MIN_CUT_DURATION", 1.0))
+SILENCE_PADDING = 0.25 # seconds of silence kept on both sides of a cut
+SILENCE_MAX_CUTS = 1000 # keeps the aselect expression evaluable for very long recordings
+MIN_SEGMENT_RATIO = 0.5 # a boundary is only moved back to a pause in the second half of the segment
+
+_silence_start_regex = re.compile(r"silence_start: (-?[\d.]+)")
+_silence_end_regex = re.compile(r"silence_end: (-?[\d.]+)")
+_duration_regex = re.compile(r"Duration: (\d+):(\d+):([\d.]+)")
+
+async def detect_silences(input_file_name: str, threshold_db: float = SILENCE_THRESHOLD_DB, min_duration: float = SILENCE_MIN_PAUSE_DURATION) -> []:
+    # returns [duration, [[silence_start, silence_end], ...]], duration is None if the container does not report it
+    args = (
+        ffmpeg
+        .input(input_file_name)
+        .filter("silencedetect", noise=f"{threshold_db}dB", d=min_duration)
+        .output("-", f="null")
+        .global_args("-nostats")
+        .compile()
+    )
+    process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+    stderr = (await process.stderr.read()).decode(errors="ignore")
+    if await process.wait() != 0:
+        raise ffmpeg.Error("ffmpeg", None, stderr.encode())
+
+    duration = None
+    match = _duration_regex.search(stderr)
+    if match != None:
+        duration = int(match.group(1)) * 3600 + int(match.group(2)) * 60 + float(match.group(3))
+    silences = []
+    silence_start = None
+    for line in stderr.splitlines():
+        start_match = _silence_start_regex.search(line)
+        end_match = _silence_end_regex.search(line)
+        if start_match != None:
+            silence_start = max(0.0, float(start_match.group(1)))
+        elif end_match != None and silence_start != None:
+            silences.append([silence_start, float(end_match.group(1))])
+            silence_start = None
+    if silence_start != None and duration != None: # silence until the end of the file
+        silences.append([silence_start, duration])
+    return [duration, silences]
+
+def plan_silence_cuts(silences: list, min_cut_duration: float = SILENCE_MIN_CUT_DURATION, padding: float = SILENCE_PADDING) -> []:
+    cuts = [[start + padding, end - padding] for start, end in silences if end - start >= min_cut_duration]
+    if len(cuts) > SILENCE_MAX_CUTS:
+        cuts = sorted(sorted(cuts, key=lambda cut: cut[1] - cut[0], reverse=True)[:SILENCE_MAX_CUTS])
+    return cuts
+
+def get_silence_filter_expression(cuts: list) -> str:
+    return "not(" + "+".join([f"between(t,{start:.3f},{end:.3f})" for start, end in cuts]) + ")"
+
+def map_to_output_time(t: float, cuts: list, speed: float) -> float:
+    removed = 0.0
+    for start, end in cuts:
+        if end <= t:
+            removed += end - start
+        elif start < t:
+            removed += t - start
+        else:
+            break
+    return (t - removed) / speed
+
+def plan_segment_times(duration: float, silences: list, cuts: list, speed: float, segment_time: float) -> []:
+    # chunk boundaries on the output timeline (after cutting and speedup), placed in pauses where possible
+    # an empty list means the whole output fits into a single segment
+    if duration == None:
+        return None
+    output_duration = map_to_output_time(duration, cuts, speed)
+    cut_starts = set([cut[0] for cut in cuts])
+    pauses = []
+    for start, end in silences:
+        pause = start + SILENCE_PADDING if start + SILENCE_PADDING in cut_starts else (start + end) / 2
+        pauses.append(map_to_output_time(pause, cuts, speed))
+
+    segment_times = []
+    last_boundary = 0.0
+    index = 0
+    while last_boundary + segment_time < output_duration:
+        limit = last_boundary + segment_time
+        boundary = None
+        while index < len(pauses) and pauses[index] <= limit:
+            if pauses[index] > last_boundary + segment_time * MIN_SEGMENT_RATIO:
+                boundary = pauses[index]
+            index += 1
+        if boundary == None:
+            boundary = limit
+        segment_times.append(boundary)
+        last_boundary = boundary
+    return segment_times
@@ -0,0 +1,221 @@
+import os
+import sys
+import json
+import asyncio
+import argparse
+import logging
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import ffmpeg
+from helpers import convert_and_speedup_audio, get_media_duration, remove_job_dir, validate_entered_language, get_current_month
+from encoding_planner import plan_encoding
+from settings_store import SettingsStore
+from stt_backends import SttBackendSelector, STT_BACKEND
+
+# Headless batch transcription of local recordings, without Telegram:
+#   python bot/batch_transcribe.py recordings/ --output transcripts.jsonl --srt-dir subtitles/
+# The input is a directory (searched recursively) or a manifest: a text file with one path per line, or a .jsonl
+# file with {"path": ..., "language": ...} per line. Files are transcoded in a process pool and their parts are
+# transcribed with bounded concurrency. Every finished file is appended to the JSONL output right away, so an
+# interrupted run continues with the missing and failed files when it is started again with the same output.
+# Whisper cost is added to the monthly usage cost of the bot.
+MEDIA_EXTENSIONS = [".aac", ".amr", ".avi", ".flac", ".m4a", ".mkv", ".mov", ".mp3", ".mp4", ".oga", ".ogg", ".opus", ".wav", ".webm", ".wma"]
+BATCH_TRANSCODE_WORKERS = int(os.environ.get("BATCH_TRANSCODE_WORKERS", os.cpu_count() or 1))
+BATCH_TRANSCRIPTION_CONCURRENCY = int(os.environ.get("BATCH_TRANSCRIPTION_CONCURRENCY", 4))
+
+logger = logging.getLogger("SST-CHATGPT-TELEGRAM-BOT")
+
+def parse_speed(value: str) -> float:
+    # unlike the /speed command, which falls back to 1.0, an invalid speed stops the batch before anything is transcoded
+    try:
+        speed = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid speed '{value}'")
+    if speed < 0.8 or speed > 1.8:
+        raise argparse.ArgumentTypeError(f"speed {value} is outside of 0.8 - 1.8")
+    return speed
+
+def get_args(settings: SettingsStore) -> object:
+    parser = argparse.ArgumentParser(description="Transcribe a directory or manifest of media files with Whisper.")
+    parser.add_argument("input", help="directory with media files or manifest (.txt with one path per line, or .jsonl)")
+    parser.add_argument("--output", default="transcripts.jsonl", help="JSONL file the transcripts are appended to")
+    parser.add_argument("--srt-dir", help="also write an SRT subtitle file per transcript into this directory")
+    parser.add_argument("--language", default=settings.language, help="speech language, 'auto' to detect it (default: bot setting)")
+    parser.add_argument("--speed", type=parse_speed, default=settings.speed, help="audio speedup between 0.8 and 1.8 before the transcription (default: bot setting)")
+    parser.add_argument("--backend", choices=["api", "local", "auto"], default=STT_BACKEND)
+    parser.add_argument("--workers", type=int, default=BATCH_TRANSCODE_WORKERS, help="ffmpeg processes")
+    parser.add_argument("--concurrency", type=int, default=BATCH_TRANSCRIPTION_CONCURRENCY, help="simultaneous transcription requests")
+    return parser.parse_args()
+
+def get_input_files(input_path: str) -> []:
+    # returns [[path, language or None], ...]
+    if os.path.isdir(input_path):
+        files = []
+        for directory, dir_names, file_names in os.walk(input_path):
+            for file_name in file_names:
+                if os.path.splitext(file_name)[1].lower() in MEDIA_EXTENSIONS:
+                    files.append([os.path.abspath(os.path.join(directory, file_name)), None])
+        return sorted(files)
+    base_dir = os.path.dirname(os.path.abspath(input_path))
+    files = []
+    with open(input_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            if input_path.endswith(".jsonl"):
+                entry = json.loads(line)
+                files.append([os.path.join(base_dir, entry["path"]), entry.get("language")])
+            else:
+                files.append([os.path.join(base_dir, line), None])
+    return files
+
+def get_finished_files(output_file: str) -> set:
+    finished = set()
+    if not os.path.isfile(output_file):
+        return finished
+    with open(output_file, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError: # last line of an interrupted run
+                continue
+            if record.get("error") == None:
+                finished.add(record["path"])
+            else:
+                finished.discard(record["path"])
+    return finished
+
+def transcode_file(input_file_name: str, output_dir: str, speed: float) -> []:
+    # runs in the process pool; returns [duration of the input, segment files]
+    duration = get_media_duration(ffmpeg.probe(input_file_name))
+    encoding = plan_encoding(duration / speed if duration != None else None)
+    return [duration, convert_and_speedup_audio(input_file_name, output_dir, speed, encoding["segment_time"], encoding)]
+
+def format_srt_time(seconds: float) -> str:
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d},{milliseconds:03d}"
+
+def write_srt(file_name: str, segments: list) -> None:
+    tmp_file_name = f"{file_name}.tmp"
+    with open(tmp_file_name, "w", encoding="utf-8") as f:
+        for index, segment in enumerate(segments):
+            f.write(f"{index + 1}\n{format_srt_time(segment['start'])} --> {format_srt_time(segment['end'])}\n{segment['text']}\n\n")
+    os.replace(tmp_file_name, file_name)
+
+
+class BatchTranscriber:
+    def __init__(self, args: object, settings: SettingsStore):
+        self.args = args
+        self.settings = settings
+        self.language = validate_entered_language(args.language)
+        self.speed = args.speed
+        if self.language == None:
+            raise ValueError(f"Invalid language '{args.language}'.")
+        self.backends = SttBackendSelector(args.backend)
+        # spawn instead of fork: the event loop must not be copied into the ffmpeg workers
+        self.executor = ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn"))
+        self.file_semaphore = asyncio.Semaphore(args.workers * 2) # keeps the transcoding just ahead of the transcription
+        self.request_semaphore = asyncio.Semaphore(args.concurrency)
+        self.output = None
+        self.stats = {"finished": 0, "failed": 0, "skipped": 0, "audio_seconds": 0.0, "cost": 0.0}
+
+    async def run(self) -> dict:
+        files = get_input_files(self.args.input)
+        finished = get_finished_files(self.args.output)
+        pending = [[path, language] for path, language in files if path not in finished]
+        self.stats["skipped"] = len(files) - len(pending)
+        print(f"{len(files)} files, {self.stats['skipped']} already transcribed, {len(pending)} to do.")
+        if self.args.srt_dir != None:
+            os.makedirs(self.args.srt_dir, exist_ok=True)
+        self.output = open(self.args.output, "a", encoding="utf-8")
+        try:
+            await asyncio.gather(*[self.process_file(path, language) for path, language in pending])
+        finally:
+            self.output.close()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            await self.backends.close()
+        return self.stats
+
+    async def process_file(self, path: str, language: str = None) -> None:
+        language = validate_entered_language(language) or self.language if language != None else self.language
+        async with self.file_semaphore:
+            job_dir = tempfile.mkdtemp(prefix="sttbatch_")
+            try:
+                duration, segment_files = await asyncio.get_running_loop().run_in_executor(self.executor, transcode_file, path, job_dir, self.speed)
+                stt_backend = self.backends.get_backend(duration)
+                results = await asyncio.gather(*[self.transcribe_segment(stt_backend, segment_file, language) for segment_file in segment_files], return_exceptions=True)
+            except Exception as e:
+                self.write_failure(path, e)
+                return
+            finally:
+                remove_job_dir(job_dir)
+
+        # parts that were transcribed are billed even if others failed
+        cost = sum([result["cost"] for result in results if not isinstance(result, BaseException)])
+        self.add_cost(cost)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if len(errors) > 0:
+            self.write_failure(path, errors[0])
+            return
+
+        # segment timestamps are relative to their part and sped up, the output refers to the original recording
+        segments = []
+        offset = 0.0
+        for result in results:
+            for segment in result["segments"]:
+                segments.append({"start": round((offset + segment["start"]) * self.speed, 3), "end": round((offset + segment["end"]) * self.speed, 3), "text": segment["text"]})
+            offset += result["duration"]
+        record = {
+            "path": path,
+            "language": language,
+            "speed": self.speed,
+            "backend": stt_backend.name,
+            "duration": duration,
+            "cost": round(cost, 6),
+            "text": " ".join([result["text"].strip() for result in results]),
+            "segments": segments
+        }
+        if self.args.srt_dir != None:
+            write_srt(os.path.join(self.args.srt_dir, f"{os.path.splitext(os.path.basename(path))[0]}.srt"), segments)
+        self.write_record(record)
+        self.stats["finished"] += 1
+        self.stats["audio_seconds"] += duration or 0.0
+        print(f"✔ {path} ({cost:.4f}$)")
+
+    async def transcribe_segment(self, stt_backend: object, file_name: str, language: str) -> dict:
+        async with self.request_semaphore:
+            return await stt_backend.transcribe(file_name, language)
+
+    def add_cost(self, cost: float) -> None:
+        if cost > 0.0:
+            self.stats["cost"] += cost
+            self.settings.add_usage_cost(cost, get_current_month())
+
+    def write_failure(self, path: str, e: BaseException) -> None:
+        self.write_record({"path": path, "error": str(e) or type(e).__name__})
+        self.stats["failed"] += 1
+        print(f"✘ {path}: {str(e)}")
+
+    def write_record(self, record: dict) -> None:
+        self.output.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.output.flush()
+
+
+async def main(args: object, settings: SettingsStore) -> dict:
+    return await BatchTranscriber(args, settings).run()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="[%(asctime)s] %(levelname)s %(message)s", level=logging.WARNING)
+    settings = SettingsStore()
+    try:
+        stats = asyncio.run(main(get_args(settings), settings))
+    finally:
+        settings.close()
+    print(f"Finished: {stats['finished']}, failed: {stats['failed']}, skipped: {stats['skipped']}, audio: {stats['audio_seconds'] / 3600:.2f} h, cost: {stats['cost']:.2f}$")
+    sys.exit(1 if stats["failed"] > 0 else 0)
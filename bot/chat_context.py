@@ -0,0 +1,76 @@
+import os
+import logging
+from helpers import ModelType
+try:
+    import tiktoken
+except ImportError: # fall back to a rough estimate of ~4 characters per token
+    tiktoken = None
+
+# Prompt token budget for the ChatGPT history (gpt-3.5-turbo has a 4096 token context window shared with the reply).
+# Once the history exceeds the budget, the oldest turns are dropped until it is back at GPT_CONTEXT_TRIM_RATIO of the budget,
+# so that trimming (and summarizing) only happens every few turns.
+GPT_CONTEXT_TOKEN_BUDGET = int(os.environ.get("GPT_CONTEXT_TOKEN_BUDGET", 3000))
+GPT_CONTEXT_TRIM_RATIO = 0.75
+GPT_SUMMARIZE_HISTORY = os.environ.get("GPT_SUMMARIZE_HISTORY", "false").lower() in ["1", "true", "yes"]
+GPT_SUMMARY_MAX_WORDS = 150
+TOKENS_PER_MESSAGE = 4 # every message is wrapped in <im_start>{role}\n{content}<im_end>\n
+
+logger = logging.getLogger("SST-CHATGPT-TELEGRAM-BOT")
+
+_encodings = {} # model -> tiktoken encoding, None if it could not be loaded
+
+def count_tokens(text: str, model: str = ModelType.GPT35.value) -> int:
+    if text == None:
+        return 0
+    if tiktoken == None:
+        return (len(text) + 3) // 4
+    if model not in _encodings:
+        try:
+            try:
+                _encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                _encodings[model] = tiktoken.get_encoding("cl100k_base")
+        except Exception as e: # e.g. the encoding could not be downloaded, not retried for every message
+            logger.error(f"Could not load the tiktoken encoding for {model}, estimating token counts: {str(e)}")
+            _encodings[model] = None
+    if _encodings[model] == None:
+        return (len(text) + 3) // 4
+    return len(_encodings[model].encode(text))
+
+def count_message_tokens(message: dict, model: str = ModelType.GPT35.value) -> int:
+    return TOKENS_PER_MESSAGE + count_tokens(message["content"], model)
+
+def get_summary_message(summary: str) -> dict:
+    return {"role": "system", "content": f"Summary of the earlier conversation: {summary}"}
+
+def build_prompt(session: object) -> []:
+    if session.summary:
+        return [get_summary_message(session.summary)] + session.messages
+    return session.messages
+
+def get_prompt_tokens(session: object) -> int:
+    if len(session.message_tokens) != len(session.messages): # e.g. history restored from disk
+        session.message_tokens = [count_message_tokens(message) for message in session.messages]
+    summary_tokens = count_message_tokens(get_summary_message(session.summary)) if session.summary else 0
+    return summary_tokens + sum(session.message_tokens)
+
+def trim_history(session: object, budget: int = GPT_CONTEXT_TOKEN_BUDGET) -> []:
+    # returns the dropped messages, oldest first; the latest message is always kept
+    if get_prompt_tokens(session) <= budget:
+        return []
+    target = int(budget * GPT_CONTEXT_TRIM_RATIO)
+    dropped = []
+    total = get_prompt_tokens(session)
+    while len(session.messages) > 1 and total > target:
+        dropped.append(session.messages.pop(0))
+        total -= session.message_tokens.pop(0)
+    return dropped
+
+def get_summarize_prompt(summary: str, dropped: list) -> []:
+    conversation = "\n".join([f"{message['role']}: {message['content']}" for message in dropped])
+    if summary:
+        conversation = f"Previous summary: {summary}\n{conversation}"
+    return [
+        {"role": "system", "content": f"Summarize the following conversation between a user and an assistant in at most {GPT_SUMMARY_MAX_WORDS} words. Keep names, facts, decisions and open questions."},
+        {"role": "user", "content": conversation}
+    ]
@@ -0,0 +1,146 @@
+import os
+import json
+import asyncio
+import time
+import logging
+from collections import OrderedDict
+
+# Per-chat conversation state, kept in a bounded LRU and evicted after being idle.
+# If CHAT_SESSION_DIR is set, the GPT history of evicted chats is stored on disk and restored on their next message.
+# With CHAT_SESSION_SHARED, the history is written through to CHAT_SESSION_DIR after every change and re-read when
+# another bot instance has changed it, so several replicas behind a webhook load balancer can serve the same chat.
+CHAT_SESSION_MAX_COUNT = int(os.environ.get("CHAT_SESSION_MAX_COUNT", 1000))
+CHAT_SESSION_IDLE_TIMEOUT = int(os.environ.get("CHAT_SESSION_IDLE_TIMEOUT", 3600)) # seconds
+CHAT_SESSION_DIR = os.environ.get("CHAT_SESSION_DIR")
+CHAT_SESSION_SHARED = os.environ.get("CHAT_SESSION_SHARED", "false").lower() in ["1", "true", "yes"]
+
+logger = logging.getLogger("SST-CHATGPT-TELEGRAM-BOT")
+
+class ChatSession:
+    def __init__(self, chat_id: int, messages: list = None):
+        self.chat_id = chat_id
+        self.user_id = None
+        self.messages = messages if messages != None else []
+        self.message_tokens = [] # token count per message of the GPT history
+        self.summary = None # running summary of the GPT turns that were trimmed from the history
+        self.thinking = None # loading message currently displayed in this chat
+        self.job_dirs = set() # temporary directories of the media jobs currently processed for this chat
+        self.lock = asyncio.Lock() # serializes the GPT turns of one chat
+        self.last_active = time.monotonic()
+        self.version = None # mtime of the session file this state was read from or written to
+
+    def touch(self) -> None:
+        self.last_active = time.monotonic()
+
+    def is_busy(self) -> bool:
+        return self.thinking != None or len(self.job_dirs) > 0
+
+    def to_dict(self) -> dict:
+        return {"chat_id": self.chat_id, "user_id": self.user_id, "messages": self.messages, "summary": self.summary}
+
+
+class ChatSessionStore:
+    def __init__(self, max_count: int = CHAT_SESSION_MAX_COUNT, idle_timeout: int = CHAT_SESSION_IDLE_TIMEOUT, directory: str = CHAT_SESSION_DIR, shared: bool = CHAT_SESSION_SHARED):
+        self.max_count = max_count
+        self.idle_timeout = idle_timeout
+        self.directory = directory
+        self.shared = shared and directory != None
+        self._sessions = OrderedDict()
+        if self.directory != None:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def get(self, chat_id: int) -> ChatSession:
+        session = self._sessions.get(chat_id)
+        if session == None:
+            session = self._load(chat_id)
+            self._sessions[chat_id] = session
+        else:
+            self._sessions.move_to_end(chat_id)
+            if self.shared:
+                self._refresh(session)
+        session.touch()
+        self.evict()
+        return session
+
+    def evict(self) -> int:
+        # the dict is ordered by last activity, so only the idle head has to be looked at
+        evicted = 0
+        now = time.monotonic()
+        for chat_id in list(self._sessions.keys()):
+            session = self._sessions[chat_id]
+            over_capacity = len(self._sessions) > self.max_count
+            if not over_capacity and now - session.last_active < self.idle_timeout:
+                break
+            if session.is_busy():
+                continue
+            self.save(session)
+            del self._sessions[chat_id]
+            evicted += 1
+        return evicted
+
+    def sync(self, session: ChatSession) -> None:
+        # called after every change of the history; only writes in shared mode
+        if self.shared:
+            self.save(session)
+
+    def save(self, session: ChatSession) -> None:
+        if self.directory == None:
+            return
+        path = self._get_path(session.chat_id)
+        try:
+            if len(session.messages) == 0 and session.summary == None:
+                if os.path.isfile(path):
+                    os.remove(path)
+                session.version = None
+                return
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(session.to_dict(), f)
+            os.replace(tmp_path, path)
+            session.version = os.stat(path).st_mtime_ns
+        except OSError as e:
+            logger.critical(f"Could not save chat session ({session.chat_id}): {str(e)}")
+
+    def save_all(self) -> None:
+        for session in self._sessions.values():
+            self.save(session)
+
+    def _load(self, chat_id: int) -> ChatSession:
+        session = ChatSession(chat_id)
+        if self.directory == None:
+            return session
+        self._read(session)
+        return session
+
+    def _refresh(self, session: ChatSession) -> None:
+        try:
+            version = os.stat(self._get_path(session.chat_id)).st_mtime_ns
+        except OSError:
+            version = None
+        if version != session.version:
+            session.messages = []
+            session.message_tokens = []
+            session.summary = None
+            self._read(session)
+
+    def _read(self, session: ChatSession) -> None:
+        path = self._get_path(session.chat_id)
+        if not os.path.isfile(path):
+            session.version = None
+            return
+        try:
+            session.version = os.stat(path).st_mtime_ns
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            session.user_id = data.get("user_id", session.user_id)
+            session.messages = data.get("messages", [])
+            session.message_tokens = []
+            session.summary = data.get("summary")
+        except (OSError, ValueError) as e:
+            logger.critical(f"Could not load chat session ({session.chat_id}): {str(e)}")
+
+    def _get_path(self, chat_id: int) -> str:
+        return os.path.join(self.directory, f"{chat_id}.json")
@@ -0,0 +1,53 @@
+import os
+import math
+
+# Picks the speech encoding and segment length for the Whisper upload. Long files are cut into about
+# TRANSCRIPTION_CHUNK_CONCURRENCY parts, which are transcribed in parallel while ffmpeg still encodes the next ones,
+# each between WHISPER_MIN_SEGMENT_TIME and WHISPER_MAX_SEGMENT_TIME long. The best bitrate is used whose parts of
+# that length stay below the API file size limit; lower bitrates only if the segment time could not be met otherwise.
+WHISPER_API_FILE_SIZE_LIMIT = 25 # MB
+WHISPER_SIZE_SAFETY_FACTOR = 0.9 # room for container overhead and VBR overshoot
+WHISPER_MIN_SEGMENT_TIME = int(os.environ.get("WHISPER_MIN_SEGMENT_TIME", 300)) # seconds, shorter parts only add requests
+WHISPER_MAX_SEGMENT_TIME = int(os.environ.get("WHISPER_MAX_SEGMENT_TIME", 1800)) # seconds
+# number of audio chunks of one file transcribed in parallel
+TRANSCRIPTION_CHUNK_CONCURRENCY = int(os.environ.get("TRANSCRIPTION_CHUNK_CONCURRENCY", 4))
+SPEECH_CODEC = "libopus"
+SPEECH_EXTENSION = "ogg"
+SPEECH_SAMPLE_RATE = 16000 # Whisper resamples everything to 16 kHz mono anyway
+SPEECH_BITRATES = [48, 32, 24, 16] # kbit/s, best quality first
+
+def get_max_segment_time(bitrate: int, limit_mb: float = WHISPER_API_FILE_SIZE_LIMIT) -> int:
+    # longest part that stays below the file size limit at this bitrate
+    limit_bits = limit_mb * 1024 * 1024 * 8 * WHISPER_SIZE_SAFETY_FACTOR
+    return int(limit_bits / (bitrate * 1000))
+
+def get_target_segment_time(output_duration: float = None) -> int:
+    if output_duration == None or output_duration <= 0:
+        return WHISPER_MAX_SEGMENT_TIME
+    segment_time = math.ceil(output_duration / TRANSCRIPTION_CHUNK_CONCURRENCY)
+    return max(WHISPER_MIN_SEGMENT_TIME, min(WHISPER_MAX_SEGMENT_TIME, segment_time))
+
+def plan_encoding(output_duration: float = None, limit_mb: float = WHISPER_API_FILE_SIZE_LIMIT) -> dict:
+    # output_duration is the audio length after silence trimming and speedup, None if unknown
+    segment_time = get_target_segment_time(output_duration)
+    bitrate = SPEECH_BITRATES[-1]
+    for candidate in SPEECH_BITRATES:
+        if get_max_segment_time(candidate, limit_mb) >= segment_time:
+            bitrate = candidate
+            break
+    return {
+        "codec": SPEECH_CODEC,
+        "extension": SPEECH_EXTENSION,
+        "bitrate": f"{bitrate}k",
+        "channels": 1,
+        "sample_rate": SPEECH_SAMPLE_RATE,
+        "segment_time": min(segment_time, get_max_segment_time(bitrate, limit_mb))
+    }
+
+def get_encoding_args(plan: dict) -> dict:
+    # output options for ffmpeg-python
+    args = {"acodec": plan["codec"], "ac": plan["channels"], "ar": plan["sample_rate"], "audio_bitrate": plan["bitrate"]}
+    if plan["codec"] == "libopus":
+        args["application"] = "voip"
+        args["vbr"] = "constrained"
+    return args
@@ -1,13 +1,15 @@
 import openai
 import os
-import sys
+import asyncio
+import tempfile
+import time
 import logging
-import usersettings
 import httpx
 import traceback
 from telegram import Update
 from telegram.ext import (
     ApplicationBuilder,
+    CallbackContext,
     ContextTypes,
     MessageHandler,
     filters,
@@ -16,62 +18,85 @@ from telegram.ext import (
     ApplicationHandlerStop,
 )
 from telegram.error import TelegramError
-from helpers import download_media, convert_and_speedup_audio, validate_entered_language, validate_entered_speed, get_command_argument, get_first_last_day_of_this_month, get_final_file_size, calculateCostbyTokens, calculateCostByDuration, ModelType, get_current_month, get_time_difference_in_months, validate_entered_cost, cleanup_files, split_text_fit_message
+from chat_sessions import ChatSession, ChatSessionStore
+from chat_context import count_tokens, count_message_tokens, build_prompt, get_prompt_tokens, trim_history, get_summarize_prompt, GPT_SUMMARIZE_HISTORY
+from openai_client import create_chat_completion, stream_chat_completion, close_session
+from telegram_dispatcher import ChatRateLimiter, send_text
+from stt_backends import SttBackend, SttBackendSelector
+from streaming_reply import StreamingReply
+from settings_store import SettingsStore
+from audio_preprocessing import detect_silences, plan_silence_cuts, plan_segment_times, get_silence_filter_expression, map_to_output_time, SILENCE_TRIMMING
+from encoding_planner import plan_encoding, TRANSCRIPTION_CHUNK_CONCURRENCY
+from transcription_cache import TranscriptionCache, get_cache_key
+from media_jobs import MediaJob, MediaJobQueue, QueueFullError
+from log_pipeline import setup_logging, set_log_context
+from metrics import span, start_trace, start_metrics_server, UPDATES, ERRORS, STAGE_DURATION, OPENAI_TOKENS, WHISPER_AUDIO_SECONDS, CACHE_REQUESTS, MEDIA_QUEUE_DEPTH, MEDIA_JOBS_RUNNING
+from helpers import download_media, close_download_client, get_media_info, probe_media, get_media_duration, get_audio_stream, extract_audio_stream, convert_and_speedup_audio_stream, remove_job_dir, validate_entered_language, validate_entered_speed, get_command_argument, get_first_last_day_of_this_month, calculateCostbyTokens, ModelType, get_current_month, validate_entered_cost
 
 # enable/disable full traceback logging for the logfile
 LOG_TRACEBACK = False
-# Init logger: Save log to file with level DEBUG and print out log to console with level CRITICAL (reason: suppress annoying _updater.py ERROR messages)
-handler = logging.StreamHandler(sys.stdout)
-handler.setLevel(logging.CRITICAL) # handler with log level for console: change to DEBUG when debugging, otherwise CRITICAL
-logging.basicConfig(
-    format="[%(asctime)s] %(levelname)s [%(filename)s.%(funcName)s:%(lineno)d] %(message)s", 
-    datefmt="%a, %d %b %Y %H:%M:%S",
-    level=logging.ERROR, # log level for log file
-    handlers= [
-        logging.FileHandler("sttchatgpttelegrambot.log"),
-        handler
-    ]
-)
 logger = logging.getLogger("SST-CHATGPT-TELEGRAM-BOT")
 
-# Limit the log level of imported modules to ERROR
-for log_name, log_obj in logging.Logger.manager.loggerDict.items():
-    #logger.critical(log_obj)
-    if log_name != 'SST-CHATGPT-TELEGRAM-BOT' and isinstance(log_obj, logging.Logger):
-        log_obj.setLevel(logging.ERROR)
-
-WHISPER_API_FILE_SIZE_LIMIT = 25
 MAX_PW_ENTER_ATTEMPTS = 5
+# webhook mode: with TELEGRAM_WEBHOOK_URL set, updates are received on a local HTTP server instead of polling getUpdates
+TELEGRAM_WEBHOOK_URL = os.environ.get("TELEGRAM_WEBHOOK_URL")
+TELEGRAM_WEBHOOK_SECRET = os.environ.get("TELEGRAM_WEBHOOK_SECRET")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", 100))
+# edit the reply in place while ChatGPT generates it instead of waiting for the full completion
+GPT_STREAM_RESPONSES = os.environ.get("GPT_STREAM_RESPONSES", "true").lower() in ["1", "true", "yes"]
 
 telegram_token = os.environ["TELEGRAM_BOT_KEY"]
 telegram_bot_password = os.environ["TELEGRAM_BOT_PW"]
 openai.api_key = os.environ["OPENAI_API_KEY"]
 
-messages_list = []
-_user_id = None
-_thinking = None
-
-# Init the local settings file
-settings = usersettings.Settings("contentcrow.sttchatgpttelegrambot")
-settings.add_setting("language", str, default="auto")
-settings.add_setting("speed", float, default=1.2)
-settings.add_setting("whitelisted_ids", list, default=[])
-settings.add_setting("blacklisted_ids", list, default=[])
-settings.add_setting("usage_cost", list, default=[0.0])
-settings.add_setting("index_zero_date", default=get_current_month())
-settings.load_settings()
-if ("TELEGRAM_BOT_WL_ID" in os.environ) and not (int(os.environ["TELEGRAM_BOT_WL_ID"]) in settings.whitelisted_ids):
-    settings.whitelisted_ids.append(int(os.environ["TELEGRAM_BOT_WL_ID"]))
-    settings.save_settings()
-
-
-def append_history(content, role) -> []:
-    messages_list.append({"role": role, "content": content})
-    return messages_list
-
-def clear_history() -> []:
-    messages_list.clear()
-    return messages_list
+# created by init_stores, not on import: the spawned local Whisper workers import this module again as __mp_main__
+chat_sessions = None
+media_jobs = None
+metrics_server = None
+stt_backends = None
+transcription_cache = None
+settings = None
+
+def setup_bot_logging() -> None:
+    # Init logger: Save log to file with level ERROR and print out log to console with level CRITICAL (reason: suppress annoying _updater.py ERROR messages)
+    # Both are written by a background thread (see log_pipeline), console level: change to DEBUG when debugging, otherwise CRITICAL
+    setup_logging(file_level=logging.ERROR, console_level=logging.CRITICAL)
+    # Limit the log level of imported modules to ERROR
+    for log_name, log_obj in logging.Logger.manager.loggerDict.items():
+        if log_name != 'SST-CHATGPT-TELEGRAM-BOT' and isinstance(log_obj, logging.Logger):
+            log_obj.setLevel(logging.ERROR)
+
+def init_stores() -> None:
+    global chat_sessions, stt_backends, transcription_cache, settings
+    chat_sessions = ChatSessionStore()
+    stt_backends = SttBackendSelector()
+    transcription_cache = TranscriptionCache()
+    # Init the local settings database (imports the old usersettings file on first start)
+    settings = SettingsStore()
+    settings.migrate_legacy_settings()
+    if ("TELEGRAM_BOT_WL_ID" in os.environ) and not (int(os.environ["TELEGRAM_BOT_WL_ID"]) in settings.whitelisted_ids):
+        settings.add_whitelisted_id(int(os.environ["TELEGRAM_BOT_WL_ID"]))
+
+
+def get_chat_session(update: object) -> ChatSession:
+    if not isinstance(update, Update) or update.effective_chat == None:
+        return None
+    return chat_sessions.get(update.effective_chat.id)
+
+def append_history(session: ChatSession, content, role) -> []:
+    message = {"role": role, "content": content}
+    session.messages.append(message)
+    session.message_tokens.append(count_message_tokens(message))
+    return session.messages
+
+def clear_history(session: ChatSession) -> []:
+    session.messages.clear()
+    session.message_tokens.clear()
+    session.summary = None
+    return session.messages
 
 # deprecated since july 2023
 def get_openai_usage_cost() -> float:
@@ -81,20 +106,14 @@ def get_openai_usage_cost() -> float:
     resp_object = resp[0]
     return resp_object.data["total_usage"]
 
-def get_usage_cost_index_for_this_month() -> int:
-    date = get_current_month()
-    difference = get_time_difference_in_months(settings.index_zero_date, date)
-    if (len(settings.usage_cost) - 1) < difference: # missing indices for months in between index_zero_month and now
-        for i in range(difference):
-            settings.usage_cost.append(0.0)
-        settings.save_settings()
-    return difference
-
 def add_to_usage_cost(cost: float) -> float:
-    index = get_usage_cost_index_for_this_month()
-    settings.usage_cost[index] = settings.usage_cost[index] + cost
-    settings.save_settings()
-    return settings.usage_cost[index]
+    return settings.add_usage_cost(cost, get_current_month())
+
+def add_gpt_usage_cost(usage: dict) -> float:
+    OPENAI_TOKENS.inc(usage["prompt_tokens"], kind="prompt")
+    OPENAI_TOKENS.inc(usage["completion_tokens"], kind="completion")
+    calculated_cost = calculateCostbyTokens(usage, ModelType.GPT35.value)
+    return add_to_usage_cost(calculated_cost)
 
 def log_traceback() -> None:
     if LOG_TRACEBACK:
@@ -102,35 +121,72 @@ def log_traceback() -> None:
         logger.error(traceback_str)
 
 async def display_loading_message(update: object, context: ContextTypes.DEFAULT_TYPE) -> object:
+    session = get_chat_session(update)
     thinking = await context.bot.send_message(
         chat_id=update.effective_chat.id, text="🤔💬"
     )
-    global _thinking
-    _thinking = thinking
+    session.thinking = thinking
     return thinking
 
 async def clear_loading_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    global _thinking
-    if _thinking == None:
+    session = get_chat_session(update)
+    if session == None or session.thinking == None:
         return
+    thinking = session.thinking
+    session.thinking = None
     await context.bot.deleteMessage(
-        message_id=_thinking.message_id, chat_id=update.message.chat_id
+        message_id=thinking.message_id, chat_id=session.chat_id
     )
-    _thinking = None
+
+async def startup(application: object) -> None:
+    init_stores()
+    logger.critical(f"The bot has been (re)started! Settings: {settings}")
+    global media_jobs
+    media_jobs = MediaJobQueue(lambda job: run_media_job(application, job))
+    MEDIA_QUEUE_DEPTH.callback = lambda: len(media_jobs)
+    MEDIA_JOBS_RUNNING.callback = media_jobs.get_running_count
+    await media_jobs.start()
+    global metrics_server
+    metrics_server = await start_metrics_server()
+
+async def shutdown(application: object) -> None:
+    if metrics_server != None:
+        metrics_server.close()
+    if media_jobs != None:
+        await media_jobs.stop()
+    chat_sessions.save_all()
+    transcription_cache.close()
+    settings.close()
+    await stt_backends.close()
+    await close_session()
+    await close_download_client()
 
 async def process_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    session = get_chat_session(update)
     thinking = await display_loading_message(update, context)
 
-    append_history(update.message.text, "user")
-    response = generate_gpt_response()
-    append_history(response, "assistant")
-
-    await clear_loading_message(update, context)
+    async with session.lock:
+        append_history(session, update.message.text, "user")
+        if GPT_STREAM_RESPONSES:
+            reply = StreamingReply(context.bot, update.effective_chat.id, thinking)
+            response = await generate_gpt_response_stream(session, reply)
+        else:
+            response = await generate_gpt_response(session)
+        if response != "":
+            append_history(session, response, "assistant")
+        chat_sessions.sync(session)
 
-    text_segments = split_text_fit_message(response)
-    for segment in text_segments:
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=segment)
-    logger.critical(f"User: {_user_id}. Proccessed text message with ChatGPT.")
+    if GPT_STREAM_RESPONSES and response == "":
+        # nothing was streamed into the loading message, e.g. the completion stopped with finish_reason "content_filter"
+        await clear_loading_message(update, context)
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id, text="⚠️ ChatGPT returned an empty reply. Please rephrase your message. ⚠️"
+        )
+    elif not GPT_STREAM_RESPONSES:
+        if await send_text(context.bot, update.effective_chat.id, response, thinking.message_id):
+            session.thinking = None # the loading message now shows the first part of the reply
+        await clear_loading_message(update, context)
+    logger.critical(f"User: {session.user_id}. Proccessed text message with ChatGPT.")
 
 
 #async def process_audio_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -145,72 +201,223 @@ async def process_text_message(update: Update, context: ContextTypes.DEFAULT_TYP
 
 
 async def process_audio_message_no_gpt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    thinking = await display_loading_message(update, context)
-
+    session = get_chat_session(update)
+    try:
+        job = await media_jobs.submit(session.user_id, update.effective_chat.id, update.to_dict())
+    except QueueFullError as e:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id, text=f"⚠️ The bot is busy right now. Please send the file again later. ⚠️"
+        )
+        logger.critical(f"User: {session.user_id}. Media job rejected: {str(e)}")
+        return
+    position = media_jobs.get_position(job)
+    text = "🤔💬" if position == 0 else f"⏳ Your file is number {position} in the queue."
+    status_message = await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+    media_jobs.set_status_message(job, status_message.message_id)
+    if job.started and position != 0: # a worker took the job while the queue position was sent
+        try:
+            await context.bot.edit_message_text(chat_id=update.effective_chat.id, message_id=status_message.message_id, text="🤔💬")
+        except TelegramError:
+            pass
+    logger.critical(f"User: {session.user_id}. Queued media job ({job.job_id}) at position {position}.")
+
+async def run_media_job(application: object, job: MediaJob) -> None:
+    start_trace(f"job-{job.job_id}")
+    set_log_context(chat_id=job.chat_id, job_id=job.job_id)
+    update = Update.de_json(job.update_data, application.bot)
+    context = CallbackContext.from_update(update, application)
+    status_message_reused = False
+    try:
+        if job.status_message_id != None:
+            try:
+                await application.bot.edit_message_text(chat_id=job.chat_id, message_id=job.status_message_id, text="🤔💬")
+            except TelegramError: # unchanged text or message deleted by the user
+                pass
+        if job.recovered:
+            await application.bot.send_message(chat_id=job.chat_id, text="♻️ Resuming your transcription after a restart of the bot.")
+        session = get_chat_session(update)
+        session.user_id = job.user_id
+        status_message_reused = await transcribe_and_reply(update, context, job.status_message_id)
+    except Exception as e:
+        await error_handler(update, CallbackContext.from_error(update, e, application))
+    finally:
+        if job.status_message_id != None and not status_message_reused:
+            try:
+                await application.bot.deleteMessage(message_id=job.status_message_id, chat_id=job.chat_id)
+            except TelegramError:
+                pass
+
+async def transcribe_and_reply(update: Update, context: ContextTypes.DEFAULT_TYPE, status_message_id: int = None) -> bool:
+    # returns True if the status message was edited into the first part of the transcript
+    session = get_chat_session(update)
     transcript_arr = await get_audio_transcription(update, context)
 
-    logger_message = f"User: {_user_id}. Transcription for '{transcript_arr[1]}' via Whisper API finished."
-    text_segments = split_text_fit_message(transcript_arr[0])
-
-    await clear_loading_message(update, context)
-
-    for segment in text_segments:
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=segment)
+    file_name = transcript_arr[1] or "transcript" # file_name is optional for audio and missing for most videos
+    logger_message = f"User: {session.user_id}. Transcription for '{file_name}' via Whisper finished{' with errors' if transcript_arr[2] else ''}."
+    document_name = f"{os.path.splitext(file_name)[0]}.txt"
+    status_message_reused = await send_text(context.bot, update.effective_chat.id, transcript_arr[0], status_message_id, document_name)
+    if transcript_arr[2]:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="⚠️ Some parts of the audio could not be transcribed. ⚠️")
     logger.critical(logger_message)
+    return status_message_reused
 
 
-def generate_gpt_response() -> str:
-    completion = openai.ChatCompletion.create(model=ModelType.GPT35.value, messages=messages_list)
-    usage = completion["usage"]
-    calculated_cost = calculateCostbyTokens(usage, ModelType.GPT35.value)
-    total_usage_cost = add_to_usage_cost(calculated_cost)
+async def prepare_gpt_prompt(session: ChatSession) -> []:
+    dropped_messages = trim_history(session)
+    if len(dropped_messages) > 0 and GPT_SUMMARIZE_HISTORY:
+        await summarize_history(session, dropped_messages)
+    return build_prompt(session)
+
+async def generate_gpt_response(session: ChatSession) -> str:
+    prompt = await prepare_gpt_prompt(session)
+    with span("gpt", messages=len(prompt)):
+        completion = await create_chat_completion(prompt, ModelType.GPT35.value)
+    total_usage_cost = add_gpt_usage_cost(completion["usage"])
     return completion.choices[0].message["content"]
 
+async def generate_gpt_response_stream(session: ChatSession, reply: StreamingReply) -> str:
+    prompt = await prepare_gpt_prompt(session)
+    response = ""
+    with span("gpt", messages=len(prompt), stream=True):
+        request_start = time.perf_counter()
+        async for delta in stream_chat_completion(prompt, ModelType.GPT35.value):
+            if response == "":
+                STAGE_DURATION.observe(time.perf_counter() - request_start, stage="gpt_first_token")
+            if delta and session.thinking != None:
+                session.thinking = None # the loading message is edited into the first part of the reply from now on
+            response += delta
+            await reply.append(delta)
+        await reply.finish()
+    # streamed completions do not report their usage, so the tokens are counted locally
+    usage = {"prompt_tokens": get_prompt_tokens(session), "completion_tokens": count_tokens(response)}
+    total_usage_cost = add_gpt_usage_cost(usage)
+    return response
+
+async def summarize_history(session: ChatSession, dropped_messages: list) -> str:
+    try:
+        with span("gpt_summary", messages=len(dropped_messages)):
+            completion = await create_chat_completion(get_summarize_prompt(session.summary, dropped_messages), ModelType.GPT35.value)
+    except Exception as e: # keep the previous summary, the reply itself can still be generated
+        logger.critical(f"User: {session.user_id}. Summarizing the message history failed: {str(e)}")
+        log_traceback()
+        return session.summary
+    add_gpt_usage_cost(completion["usage"])
+    session.summary = completion.choices[0].message["content"]
+    return session.summary
+
 
 async def get_audio_transcription(update: object, context: ContextTypes.DEFAULT_TYPE) -> []:
-    file_arr = await download_media(update, context)
-    downloaded_file = file_arr[0]
-    converted_file_names = convert_and_speedup_audio(downloaded_file, settings.speed, 720)
+    session = get_chat_session(update)
+    media_info = get_media_info(update.message)
+    stt_backend = stt_backends.get_backend(media_info["duration"])
+    cache_key = get_cache_key(media_info["file_unique_id"], settings.language, settings.speed, stt_backend.name, SILENCE_TRIMMING)
+    cached_transcript = transcription_cache.get(cache_key)
+    CACHE_REQUESTS.inc(result="hit" if cached_transcript != None else "miss")
+    if cached_transcript != None:
+        logger.critical(f"User: {session.user_id}. Transcription for '{media_info['file_name']}' served from cache.")
+        return [cached_transcript, media_info["file_name"], False]
+
+    # everything of this job (download and segments) lives in one temp directory which is removed at the end
+    job_dir = tempfile.mkdtemp(prefix="sttbot_")
+    session.job_dirs.add(job_dir)
+    semaphore = asyncio.Semaphore(TRANSCRIPTION_CHUNK_CONCURRENCY)
+
+    async def transcribe_chunk(file_name) -> str:
+        async with semaphore:
+            return await get_partial_transcription_or_error(session, stt_backend, file_name)
+
+    # each segment is uploaded while ffmpeg is still encoding the next ones
+    transcription_tasks = []
+    try:
+        with span("download", media_type=media_info["media_type"]):
+            file_arr = await download_media(update, context, job_dir)
+        downloaded_file = file_arr[0]
+        probe = None
+        if media_info["media_type"] == "video":
+            # video fast path: only the audio track is copied out, so the later passes never touch the video stream
+            probe = await probe_media(downloaded_file)
+            if get_audio_stream(probe) == None:
+                raise Exception("The video does not contain an audio track.")
+            with span("extract_audio"):
+                audio_file = await extract_audio_stream(downloaded_file, job_dir)
+            if os.path.dirname(downloaded_file) == job_dir:
+                os.remove(downloaded_file)
+            downloaded_file = audio_file
+        silence_filter = None
+        segment_times = None
+        if SILENCE_TRIMMING:
+            with span("silence_detect"):
+                [duration, silences] = await detect_silences(downloaded_file)
+            cuts = plan_silence_cuts(silences)
+            silence_filter = get_silence_filter_expression(cuts) if len(cuts) > 0 else None
+        else:
+            probe = probe if probe != None else await probe_media(downloaded_file)
+            duration = get_media_duration(probe)
+            cuts = []
+        # the encoding plan keeps every segment just below the Whisper upload limit
+        encoding = plan_encoding(map_to_output_time(duration, cuts, settings.speed) if duration != None else None)
+        if SILENCE_TRIMMING:
+            segment_times = plan_segment_times(duration, silences, cuts, settings.speed, encoding["segment_time"])
+        async for file_name in convert_and_speedup_audio_stream(downloaded_file, job_dir, settings.speed, encoding["segment_time"], silence_filter, segment_times, encoding):
+            transcription_tasks.append(asyncio.create_task(transcribe_chunk(file_name)))
+        partial_transcripts = await asyncio.gather(*transcription_tasks)
+    except BaseException:
+        for task in transcription_tasks:
+            task.cancel()
+        raise
+    finally:
+        remove_job_dir(job_dir)
+        session.job_dirs.discard(job_dir)
+    errors = [partial for partial in partial_transcripts if isinstance(partial, Exception)]
+    if len(partial_transcripts) > 0 and len(errors) == len(partial_transcripts):
+        raise errors[0] # e.g. the quota error, which the error handler shows to the user
+
     transcript = ""
+    cost = 0.0
     has_error = False
-    for file_name in converted_file_names:
-        transcript += (await get_partial_transcription(file_name) + " ")
-    cleanup_files()
+    for index, partial in enumerate(partial_transcripts):
+        if isinstance(partial, Exception):
+            has_error = True
+            transcript += f"[Part {index + 1}/{len(partial_transcripts)} could not be transcribed] "
+        else:
+            transcript += (partial[0] + " ")
+            cost += partial[1]
+    if not has_error:
+        transcription_cache.put(cache_key, transcript, cost)
     return [transcript, file_arr[1], has_error]
 
-async def get_partial_transcription(file_name) -> str:
-    transcript = ""
-    with open(file_name, "rb") as f:
-        if settings.language == "auto":
-            transcript_obj = openai.Audio.transcribe(
-                file = f,
-                model = ModelType.WHISPER.value,
-                response_format="verbose_json"
-                #response_format="text", # verbose_json, srt, vtt, text
-            )
-        else:
-            transcript_obj = openai.Audio.transcribe(
-                file = f,
-                model = ModelType.WHISPER.value,
-                response_format="verbose_json",
-                language=settings.language
-            )
-        duration = transcript_obj["duration"]
-        calculated_cost = calculateCostByDuration(duration)
+async def get_partial_transcription_or_error(session: ChatSession, stt_backend: SttBackend, file_name) -> object:
+    # returns the exception instead of raising it, so the other parts are still transcribed
+    # transient API errors are already retried by the request scheduler, anything else (file size, quota, 4xx) would fail again
+    try:
+        return await get_partial_transcription(stt_backend, file_name)
+    except Exception as e:
+        logger.critical(f"User: {session.user_id}. Transcription of '{file_name}' failed: {str(e)}")
+        log_traceback()
+        return e
+
+async def get_partial_transcription(stt_backend: SttBackend, file_name) -> []:
+    with span("whisper_chunk", chunk=os.path.basename(file_name), backend=stt_backend.name):
+        transcript_obj = await stt_backend.transcribe(file_name, settings.language)
+    WHISPER_AUDIO_SECONDS.inc(round(transcript_obj["duration"]))
+    calculated_cost = transcript_obj["cost"]
+    if calculated_cost > 0.0:
         total_usage_cost = add_to_usage_cost(calculated_cost)
-        transcript = transcript_obj["text"]
-    return transcript
+    return [transcript_obj["text"], calculated_cost]
 
 async def reset_history(update: object, context: ContextTypes.DEFAULT_TYPE) -> []:
-    clear_history()
+    session = get_chat_session(update)
+    clear_history(session)
+    chat_sessions.sync(session)
     await context.bot.send_message(
         chat_id=update.effective_chat.id, text="Messages history cleared."
     )
-    logger.critical(f"User ({_user_id}) cleared the message history.")
-    return messages_list
+    logger.critical(f"User ({session.user_id}) cleared the message history.")
+    return session.messages
 
 
 async def set_language(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    session = get_chat_session(update)
     if hasattr(update, "message") and hasattr(update.message, "text"):
         entered_language = get_command_argument("/language ", update.message.text)
     elif hasattr(update, "edited_message"):
@@ -219,15 +426,15 @@ async def set_language(update: object, context: ContextTypes.DEFAULT_TYPE) -> No
         entered_language = "auto"
 
     settings.language = validate_entered_language(entered_language)
-    settings.save_settings()
 
     await context.bot.send_message(
         chat_id=update.effective_chat.id, text=f"Speech language set to '{settings.language}'."
     )
-    logger.critical(f"User ({_user_id}) set speech language to '{settings.language}'.")
+    logger.critical(f"User ({session.user_id}) set speech language to '{settings.language}'.")
 
 
 async def set_speed(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    session = get_chat_session(update)
     if hasattr(update, "message") and hasattr(update.message, "text"):
         entered_speed = get_command_argument("/speed ", update.message.text)
     elif hasattr(update, "edited_message"):
@@ -236,23 +443,25 @@ async def set_speed(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
         entered_speed = "1.0"
 
     settings.speed = validate_entered_speed(entered_speed)
-    settings.save_settings()
 
     await context.bot.send_message(
         chat_id=update.effective_chat.id, text=f"Audio speed set to '{settings.speed}x'."
     )
-    logger.critical(f"User ({_user_id}) set audio speed to '{settings.speed}x'.")
+    logger.critical(f"User ({session.user_id}) set audio speed to '{settings.speed}x'.")
 
 
 async def show_info(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    session = get_chat_session(update)
     # deprecated: cost = round(get_openai_usage_cost() / 100.0, 2)
-    cost = settings.usage_cost[get_usage_cost_index_for_this_month()]
+    cost = settings.get_usage_cost(get_current_month())
+    cache_stats = transcription_cache.get_stats()
     await context.bot.send_message(
-        chat_id=update.effective_chat.id, text=f"Total usage cost this month: {cost:.2f}$\nSpeech language: {settings.language}\nAudio speed: {settings.speed}x"
+        chat_id=update.effective_chat.id, text=f"Total usage cost this month: {cost:.2f}$\nSpeech language: {settings.language}\nAudio speed: {settings.speed}x\nTranscription cache: {int(cache_stats['hits'])} hits, {cache_stats['saved_cost']:.2f}$ saved\nMedia queue: {len(media_jobs)} waiting, {media_jobs.get_running_count()} running"
     )
-    logger.critical(f"User ({_user_id}) displayed infos: language={settings.language}, speed={settings.speed}x, usage_cost={cost}$")
+    logger.critical(f"User ({session.user_id}) displayed infos: language={settings.language}, speed={settings.speed}x, usage_cost={cost}$, cache_hits={int(cache_stats['hits'])}, cache_saved_cost={cache_stats['saved_cost']}$")
 
 async def add_cost(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    session = get_chat_session(update)
     if hasattr(update, "message") and hasattr(update.message, "text"):
         entered_cost = get_command_argument("/add_cost ", update.message.text)
     elif hasattr(update, "edited_message"):
@@ -267,10 +476,18 @@ async def add_cost(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
         await context.bot.send_message(
             chat_id=update.effective_chat.id, text=f"Added {entered_cost:.2f}$ usage cost. Total usage cost this month is now: {total_usage_cost:.2f}$"
         )
-        logger.critical(f"User ({_user_id}) added usage cost of {entered_cost}$. Total usage cost for this month is now: {total_usage_cost}$")
+        logger.critical(f"User ({session.user_id}) added usage cost of {entered_cost}$. Total usage cost for this month is now: {total_usage_cost}$")
+
+async def deduplicate_update(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Telegram redelivers webhook updates that were not acknowledged in time, possibly to another replica
+    if isinstance(update, Update) and not settings.claim_update(update.update_id):
+        logger.critical(f"Dropped duplicate update ({update.update_id}).")
+        raise ApplicationHandlerStop
 
 async def chat_guard(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
-    count = context.user_data.get("usageCount", 0)
+    start_trace()
+    set_log_context(chat_id=update.effective_chat.id if update.effective_chat != None else None)
+    UPDATES.inc(type="edited_message" if update.edited_message != None else "message")
     if hasattr(update, "message") and hasattr(update.message, "from_user"):
         user_id = update.message.from_user.id
         user_firstname = update.message.from_user.first_name
@@ -280,16 +497,18 @@ async def chat_guard(update: object, context: ContextTypes.DEFAULT_TYPE) -> None
         user_firstname = update.edited_message.from_user.first_name
         text = update.edited_message.text
 
-    global _user_id
-    _user_id = user_id
+    session = get_chat_session(update)
+    if session != None:
+        session.user_id = user_id
 
     if user_id in settings.blacklisted_ids:
         raise ApplicationHandlerStop
     elif user_id in settings.whitelisted_ids:
-        pass
-    elif count < MAX_PW_ENTER_ATTEMPTS and "/password " in text and get_command_argument("/password ", text) == telegram_bot_password:
-        settings.whitelisted_ids.append(int(user_id))
-        settings.save_settings()
+        return
+    # failed attempts are shared by all bot instances, so a client cannot get fresh attempts from another one
+    count = settings.get_password_attempts(user_id)
+    if count < MAX_PW_ENTER_ATTEMPTS and "/password " in text and get_command_argument("/password ", text) == telegram_bot_password:
+        settings.add_whitelisted_id(user_id)
         await context.bot.send_message(
             chat_id=update.effective_chat.id, text=f"Welcome {user_firstname}! Your user_id {user_id} has been whitelisted."
         )
@@ -298,17 +517,14 @@ async def chat_guard(update: object, context: ContextTypes.DEFAULT_TYPE) -> None
         )
         logger.critical(f"Chat-Guard: User ({user_id}) was successfully whitelisted!")
     elif count < MAX_PW_ENTER_ATTEMPTS:
-        context.user_data["usageCount"] = count + 1
-        attempt = MAX_PW_ENTER_ATTEMPTS - count
+        attempt = MAX_PW_ENTER_ATTEMPTS - settings.add_password_attempt(user_id) + 1
         await context.bot.send_message(
             chat_id=update.effective_chat.id, text=f"This is a private bot. Please enter the correct password! You have {attempt} attempt{'s' if attempt > 1 else ''} left."
         )
         logger.critical(f"Chat-Guard: User ({user_id}) tried to access the bot without being whitelisted.")
         raise ApplicationHandlerStop
     elif count == MAX_PW_ENTER_ATTEMPTS:
-        context.user_data["usageCount"] = count + 1
-        settings.blacklisted_ids.append(user_id)
-        settings.save_settings()
+        settings.add_blacklisted_id(user_id)
         await context.bot.send_message(
             chat_id=update.effective_chat.id, text=f"🛑 You have been permanently blocked by this bot. 🛑"
         )
@@ -319,11 +535,14 @@ async def chat_guard(update: object, context: ContextTypes.DEFAULT_TYPE) -> None
 
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    session = get_chat_session(update)
+    user_id = session.user_id if session != None else None
+    ERRORS.inc(type=type(context.error).__name__)
     try:
         raise context.error
     except httpx.HTTPError as e:
         # Handle httpx-specific errors
-        logger.critical(f"HTTPx Error for user ({_user_id}): {str(e)}")
+        logger.critical(f"HTTPx Error for user ({user_id}): {str(e)}")
         log_traceback()
     except TelegramError as e:
         e_string = str(e)
@@ -332,13 +551,15 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
         if ("httpx.LocalProtocolError" in e_string or "httpx.RemoteProtocolError" in e_string or "httpx.WriteError" in e_string or "httpx.ReadError" in e_string or "httpx.ConnectError" in e_string):
             pass
         else:
-            logger.critical(f"Telegram Error for user ({_user_id}): {e_string}")
+            logger.critical(f"Telegram Error for user ({user_id}): {e_string}")
         log_traceback()
     except Exception as e:
         e_string = str(e)
         # Handle other unexpected errors
-        logger.critical(f"Unexpected Error for user ({_user_id}): {e_string}")
+        logger.critical(f"Unexpected Error for user ({user_id}): {e_string}")
         log_traceback()
+        if session == None:
+            return
         await clear_loading_message(update, context)
         if "quota" in e_string or "Message is too long" in e_string: # quota error and message too long error
             await context.bot.send_message(
@@ -348,13 +569,9 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
             await context.bot.send_message(
                 chat_id=update.effective_chat.id, text=f"⚠️ Unknown Error: Please contact the bot administrator. ⚠️"
             )
-    finally: # always clean up any left behind files
-        cleanup_files()
 
 
-if __name__ == "__main__":
-    application = ApplicationBuilder().token(telegram_token).build()
-
+def register_handlers(application: object) -> None:
     type_handler = TypeHandler(Update, chat_guard)
     application.add_handler(type_handler, -1)
 
@@ -374,5 +591,23 @@ if __name__ == "__main__":
 
     application.add_error_handler(error_handler)
 
-    logger.critical(f"The bot has been (re)started! Settings: {settings}")
-    application.run_polling()
+
+if __name__ == "__main__":
+    setup_bot_logging()
+    application = ApplicationBuilder().token(telegram_token).concurrent_updates(True).rate_limiter(ChatRateLimiter()).post_init(startup).post_shutdown(shutdown).build()
+    register_handlers(application)
+
+    if TELEGRAM_WEBHOOK_URL != None:
+        application.add_handler(TypeHandler(Update, deduplicate_update), -2)
+        if TELEGRAM_WEBHOOK_SECRET == None:
+            logger.critical("TELEGRAM_WEBHOOK_SECRET is not set: requests to the webhook are not verified.")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=TELEGRAM_WEBHOOK_URL.rstrip("/") + "/" + WEBHOOK_PATH,
+            secret_token=TELEGRAM_WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS
+        )
+    else:
+        application.run_polling()
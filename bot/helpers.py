@@ -1,5 +1,9 @@
 import os
+import json
+import shutil
+import asyncio
 import ffmpeg
+import httpx
 import math
 import sys
 from enum import Enum
@@ -7,12 +11,12 @@ from datetime import datetime
 from dateutil.relativedelta import relativedelta
 from langcodes import *
 from pydub import AudioSegment
+from encoding_planner import get_encoding_args
+from metrics import span
 from telegram.ext import (
     ContextTypes,
 )
 
-_file = None
-
 # API model types
 class ModelType(Enum):
     GPT4 = 'gpt-4'
@@ -27,77 +31,176 @@ class ModelCost(Enum):
     GPT35_OUTPUT = 0.00002 # 4k content
     WHISPER = 0.0001 # per second of audio (rounded to the nearest second)
 
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = 300 # seconds
+
+_download_client = None # pooled HTTP client for the media downloads
+
 supported_languages = ["af", "ar", "hy", "az", "be", "bs", "bg", "ca", "zh", "hr", "cs", "da", "nl", "en", "et", "fi", "fr", "gl", "de", "el", "he", "hi", "hu", "is", "id", "it", "ja", "kn", "kk", "ko", "lv", "lt", "mk", "ms", "mr", "mi", "ne", "no", "fa", "pl", "pt", "ro", "ru", "sr", "sk", "sl", "es", "sw", "sv", "tl", "ta", "th", "tr", "uk", "ur", "vi", "cy"]
 
-async def download_media(update: object, context: ContextTypes.DEFAULT_TYPE) -> []:
-    if hasattr(update.message, "voice") and update.message.voice != None:
-        file_id = update.message.voice.file_id
-        file_extension = get_file_extension(update.message.voice.mime_type)
+def get_media_info(message: object) -> object:
+    if hasattr(message, "voice") and message.voice != None:
+        media = message.voice
+        media_type = "voice"
         file_name = "voice message"
-    elif hasattr(update.message, "audio") and update.message.audio != None:
-        file_id = update.message.audio.file_id
-        file_extension = get_file_extension(update.message.audio.mime_type)
-        file_name = update.message.audio.file_name
-    elif hasattr(update.message, "video") and update.message.video != None:
-        file_id = update.message.video.file_id
-        file_extension = get_file_extension(update.message.video.mime_type)
-        file_name = update.message.video.file_name
+    elif hasattr(message, "audio") and message.audio != None:
+        media = message.audio
+        media_type = "audio"
+        file_name = message.audio.file_name
+    elif hasattr(message, "video") and message.video != None:
+        media = message.video
+        media_type = "video"
+        file_name = message.video.file_name
     else:
         return None
-    new_file = await context.bot.get_file(file_id)
-    f = await new_file.download_to_drive(file_id + file_extension)
-    return [f, file_name]
-
-def convert_and_speedup_audio(audio_file: object, speed: float = 1.2, segment_time: int = 720) -> object:
-    file_split = audio_file.name.split('.')
-    file_name = file_split[0]
-    file_name_ = file_name + "_"
-    global _file
-    _file = file_name
-    #file_extension = file_split[1]
+    return {
+        "media_type": media_type,
+        "file_id": media.file_id,
+        "file_unique_id": media.file_unique_id,
+        "duration": getattr(media, "duration", None),
+        "file_extension": get_file_extension(media.mime_type),
+        "file_name": file_name
+    }
+
+def get_download_client() -> httpx.AsyncClient:
+    global _download_client
+    if _download_client == None or _download_client.is_closed:
+        _download_client = httpx.AsyncClient(timeout=httpx.Timeout(DOWNLOAD_TIMEOUT))
+    return _download_client
+
+async def close_download_client() -> None:
+    global _download_client
+    if _download_client != None and not _download_client.is_closed:
+        await _download_client.aclose()
+    _download_client = None
+
+async def download_media(update: object, context: ContextTypes.DEFAULT_TYPE, output_dir: str) -> []:
+    # streams the file in chunks into the job directory instead of holding it in memory
+    media_info = get_media_info(update.message)
+    if media_info == None:
+        return None
+    new_file = await context.bot.get_file(media_info["file_id"])
+    file_path = os.path.join(output_dir, "media" + media_info["file_extension"])
+    if os.path.isfile(new_file.file_path): # local Bot API server
+        return [new_file.file_path, media_info["file_name"]]
+    try:
+        async with get_download_client().stream("GET", new_file.file_path) as response:
+            response.raise_for_status()
+            with open(file_path, "wb") as f:
+                async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+    except httpx.HTTPError as e:
+        # the file URL contains the bot token, so neither the message nor the chained exception may be logged
+        status = f" (HTTP {e.response.status_code})" if isinstance(e, httpx.HTTPStatusError) else ""
+        raise Exception(f"Downloading the file from Telegram failed{status}: {type(e).__name__}") from None
+    return [file_path, media_info["file_name"]]
+
+def get_segment_output_args(encoding: dict = None) -> []:
+    # returns [file extension, ffmpeg output options] of the segments
+    # encoding is a plan from encoding_planner.plan_encoding, without it the segments are encoded as VBR mp3.
+    if encoding != None:
+        return [encoding["extension"], get_encoding_args(encoding)]
+    return ["mp3", {"acodec": "libmp3lame", "q:a": 0}]
+
+def convert_and_speedup_audio(input_file_name: str, output_dir: str, speed: float = 1.2, segment_time: int = 720, encoding: dict = None) -> object:
+    extension, encoding_args = get_segment_output_args(encoding)
     (
         ffmpeg
-        .input(audio_file.name)
+        .input(input_file_name)
         .filter("atempo", speed)
-        .output(file_name + "_%03d.mp3", f="segment", segment_time=segment_time)
-        .global_args("-c:a", "libmp3lame")
-        .global_args("-q:a", "0")
+        .output(os.path.join(output_dir, f"segment_%03d.{extension}"), f="segment", segment_time=segment_time, **encoding_args)
         .global_args("-loglevel", "error")
         .global_args("-nostats")
         .run()
     )
-    #os.remove(audio_file)
     filenames = []
-    for filename in os.listdir("."):
-        if os.path.isfile(os.path.join(".", filename)) and file_name_ in filename:
-            filenames.append(filename)
-    return filenames;
-
-def cleanup_files() -> None:
-    global _file
-    if _file == None:
+    for filename in os.listdir(output_dir):
+        if filename.startswith("segment_"):
+            filenames.append(os.path.join(output_dir, filename))
+    # segments are numbered _000, _001, ... and have to be transcribed in that order
+    return sorted(filenames)
+
+async def probe_media(input_file_name: str) -> dict:
+    process = await asyncio.create_subprocess_exec(
+        "ffprobe", "-v", "error", "-print_format", "json", "-show_format", "-show_streams", input_file_name,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise ffmpeg.Error("ffprobe", stdout, stderr)
+    return json.loads(stdout.decode())
+
+def get_media_duration(probe: dict) -> float:
+    try:
+        return float(probe["format"]["duration"])
+    except (KeyError, ValueError):
+        return None
+
+def get_audio_stream(probe: dict) -> dict:
+    for stream in probe.get("streams", []):
+        if stream.get("codec_type") == "audio":
+            return stream
+    return None
+
+async def extract_audio_stream(input_file_name: str, output_dir: str) -> str:
+    # copies the first audio track of a video into a Matroska audio file without decoding anything
+    output_file_name = os.path.join(output_dir, "audio.mka")
+    args = (
+        ffmpeg
+        .input(input_file_name)
+        .output(output_file_name, map="0:a:0", acodec="copy", vn=None, sn=None, dn=None)
+        .global_args("-loglevel", "error")
+        .global_args("-nostats")
+        .compile()
+    )
+    process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+    stderr = await process.stderr.read()
+    if await process.wait() != 0:
+        raise ffmpeg.Error("ffmpeg", None, stderr)
+    return output_file_name
+
+async def convert_and_speedup_audio_stream(input_file_name: str, output_dir: str, speed: float = 1.2, segment_time: int = 720, silence_filter: str = None, segment_times: list = None, encoding: dict = None) -> object:
+    # Same conversion as convert_and_speedup_audio, but every segment is yielded as soon as ffmpeg has closed it.
+    # ffmpeg prints the finished segments to stdout through the segment list.
+    # silence_filter is an aselect expression for the parts to keep, segment_times overrides the fixed segment_time.
+    stream = ffmpeg.input(input_file_name)
+    if silence_filter != None:
+        stream = stream.filter("aselect", silence_filter).filter("asetpts", "N/SR/TB")
+    if segment_times != None and len(segment_times) > 0:
+        segment_args = {"segment_times": ",".join([f"{t:.3f}" for t in segment_times])}
+    else:
+        # no planned boundaries means the audio fits into one segment; without any option the muxer would cut every 2 s
+        segment_args = {"segment_time": segment_time}
+    extension, encoding_args = get_segment_output_args(encoding)
+    args = (
+        stream
+        .filter("atempo", speed)
+        .output(os.path.join(output_dir, f"segment_%03d.{extension}"), f="segment", segment_list="pipe:1", segment_list_type="flat", **segment_args, **encoding_args)
+        .global_args("-loglevel", "error")
+        .global_args("-nostats")
+        .compile()
+    )
+    with span("transcode"):
+        process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        # stderr is drained while stdout is read, otherwise ffmpeg blocks as soon as the stderr pipe is full
+        stderr_task = asyncio.create_task(process.stderr.read())
+        try:
+            async for line in process.stdout:
+                segment_name = line.decode().strip()
+                if segment_name != "":
+                    yield os.path.join(output_dir, os.path.basename(segment_name))
+            if await process.wait() != 0:
+                raise ffmpeg.Error("ffmpeg", None, await stderr_task)
+        finally:
+            if process.returncode == None:
+                process.kill()
+                await process.wait()
+            stderr_task.cancel()
+
+def remove_job_dir(job_dir: str) -> None:
+    if job_dir == None:
         return
-    for filename in os.listdir("."):
-        if os.path.isfile(os.path.join(".", filename)) and _file in filename and not ".py" in filename:
-            os.remove(filename)
-    _file = None
-
-def split_text_fit_message(input_text: str, split_at: int = 4095) -> []:
-    if input_text == None:
-        return []
-    length = len(input_text)
-    segments = []
-    start_index = 0
-    while start_index < length:
-        end_index = input_text.rfind(".", start_index, start_index + 4095)
-        if start_index + 4095 >= length:
-            segments.append(input_text[start_index:])
-            break
-        elif end_index == -1:
-            end_index = start_index + 4095
-        segments.append(input_text[start_index:end_index+1])
-        start_index = end_index + 1
-    return segments
+    shutil.rmtree(job_dir, ignore_errors=True)
 
 def get_file_extension(mime_type: str) -> str:
     return "." + mime_type.split('/')[1]
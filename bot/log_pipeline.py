@@ -0,0 +1,98 @@
+import os
+import sys
+import copy
+import json
+import queue
+import atexit
+import logging
+import logging.handlers
+from datetime import datetime, timezone
+from contextvars import ContextVar
+from metrics import get_trace_id
+
+# Logging off the event loop: handlers only put records into a queue, a QueueListener thread formats and writes them.
+# The log file is rotated by size (LOG_MAX_MB) or, with LOG_ROTATE_WHEN (e.g. "midnight", "h"), by time, keeping
+# LOG_BACKUP_COUNT old files. LOG_FORMAT "json" writes one JSON object per line, tagged with the chat id, media job id
+# and trace id of the update that logged it; "text" keeps the classic one-line format.
+LOG_FILE = os.environ.get("LOG_FILE", "sttchatgpttelegrambot.log")
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json").lower()
+LOG_MAX_MB = float(os.environ.get("LOG_MAX_MB", 10))
+LOG_ROTATE_WHEN = os.environ.get("LOG_ROTATE_WHEN")
+LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", 5))
+TEXT_FORMAT = "[%(asctime)s] %(levelname)s [%(filename)s.%(funcName)s:%(lineno)d] %(message)s"
+TEXT_DATE_FORMAT = "%a, %d %b %Y %H:%M:%S"
+
+_chat_id = ContextVar("log_chat_id", default=None)
+_job_id = ContextVar("log_job_id", default=None)
+_listener = None
+
+def set_log_context(chat_id: int = None, job_id: int = None) -> None:
+    # tags the records logged by the current task (and its subtasks)
+    _chat_id.set(chat_id)
+    _job_id.set(job_id)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "location": f"{record.filename}.{record.funcName}:{record.lineno}",
+            "message": record.getMessage(),
+            "chat_id": getattr(record, "chat_id", None),
+            "job_id": getattr(record, "job_id", None),
+            "trace_id": getattr(record, "trace_id", None),
+        }
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    # runs in the logging task: captures the context there, everything else happens in the listener thread
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.chat_id = _chat_id.get()
+        record.job_id = _job_id.get()
+        record.trace_id = get_trace_id()
+        return record
+
+
+def get_file_handler(file_name: str = LOG_FILE) -> logging.Handler:
+    if LOG_ROTATE_WHEN:
+        return logging.handlers.TimedRotatingFileHandler(file_name, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+    return logging.handlers.RotatingFileHandler(file_name, maxBytes=int(LOG_MAX_MB * 1024 * 1024), backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+
+def setup_logging(file_level: int = logging.ERROR, console_level: int = logging.CRITICAL) -> logging.handlers.QueueListener:
+    global _listener
+    if _listener != None:
+        return _listener
+    file_handler = get_file_handler()
+    file_handler.setLevel(file_level)
+    file_handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT, TEXT_DATE_FORMAT))
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setLevel(console_level)
+    console_handler.setFormatter(logging.Formatter(TEXT_FORMAT, TEXT_DATE_FORMAT))
+
+    log_queue = queue.SimpleQueue() # unbounded: logging must never block the event loop
+    root = logging.getLogger()
+    root.setLevel(min(file_level, console_level))
+    root.handlers = [ContextQueueHandler(log_queue)]
+    _listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+def stop_logging() -> None:
+    # writes the records still queued, called on exit
+    global _listener
+    if _listener != None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,205 @@
+import os
+import json
+import socket
+import time
+import sqlite3
+import asyncio
+import logging
+from collections import OrderedDict, deque
+
+# Queue for the media transcription jobs (download -> ffmpeg -> Whisper).
+# A fixed number of workers bounds the concurrent ffmpeg processes, users are served round-robin so one user's burst
+# of videos does not block everybody else, and queued jobs are kept in SQLite so they survive a restart.
+MEDIA_JOB_WORKERS = int(os.environ.get("MEDIA_JOB_WORKERS", 2))
+MEDIA_JOB_QUEUE_SIZE = int(os.environ.get("MEDIA_JOB_QUEUE_SIZE", 50))
+MEDIA_JOB_DB_FILE = os.environ.get("MEDIA_JOB_DB_FILE", "media_jobs.db")
+# several bot replicas may share the database, each one recovers its own jobs and the jobs of replicas that stopped
+# sending heartbeats (e.g. a container that was recreated under a new host name)
+BOT_INSTANCE_ID = os.environ.get("BOT_INSTANCE_ID", socket.gethostname())
+MEDIA_JOB_HEARTBEAT_INTERVAL = 30 # seconds
+MEDIA_JOB_ORPHAN_TIMEOUT = float(os.environ.get("MEDIA_JOB_ORPHAN_TIMEOUT", 120)) # seconds without heartbeat
+
+logger = logging.getLogger("SST-CHATGPT-TELEGRAM-BOT")
+
+class QueueFullError(Exception):
+    pass
+
+
+class MediaJob:
+    def __init__(self, job_id: int, user_id: int, chat_id: int, update_data: dict, status_message_id: int = None, recovered: bool = False):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.update_data = update_data # Update.to_dict() of the media message
+        self.status_message_id = status_message_id # message showing the queue position / loading state
+        self.recovered = recovered # queued before the last restart
+        self.started = False # picked up by a worker
+
+
+class MediaJobQueue:
+    def __init__(self, handler: object, workers: int = MEDIA_JOB_WORKERS, max_size: int = MEDIA_JOB_QUEUE_SIZE, path: str = MEDIA_JOB_DB_FILE, instance_id: str = BOT_INSTANCE_ID):
+        self.handler = handler # async handler(job), called by the workers
+        self.instance_id = instance_id
+        self.workers = workers
+        self.max_size = max_size
+        self._queues = OrderedDict() # user_id -> deque of jobs, in round-robin order
+        self._size = 0
+        self._running = 0
+        self._available = asyncio.Condition()
+        self._worker_tasks = []
+        self._heartbeat_task = None
+        self._running_ids = set()
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS media_jobs (
+                job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                update_data TEXT NOT NULL,
+                status_message_id INTEGER,
+                created_at REAL NOT NULL
+            )
+        """)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS media_job_instances (
+                instance_id TEXT PRIMARY KEY,
+                heartbeat REAL NOT NULL
+            )
+        """)
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(media_jobs)")]
+        if "instance_id" not in columns:
+            self.connection.execute("ALTER TABLE media_jobs ADD COLUMN instance_id TEXT")
+            self.connection.execute("UPDATE media_jobs SET instance_id = ?", (self.instance_id,))
+        self.connection.commit()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def get_running_count(self) -> int:
+        return self._running
+
+    async def start(self) -> int:
+        # re-queues the jobs that were not finished before the last shutdown, returns their number
+        self._send_heartbeat()
+        self._claim_orphaned_jobs()
+        self._worker_tasks = [asyncio.create_task(self._worker()) for i in range(self.workers)]
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+        return await self._recover()
+
+    async def stop(self) -> None:
+        tasks = self._worker_tasks + ([self._heartbeat_task] if self._heartbeat_task != None else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._worker_tasks = []
+        self._heartbeat_task = None
+        # the remaining jobs can be taken over by another replica right away
+        with self.connection:
+            self.connection.execute("DELETE FROM media_job_instances WHERE instance_id = ?", (self.instance_id,))
+        self.connection.close()
+
+    async def submit(self, user_id: int, chat_id: int, update_data: dict) -> MediaJob:
+        if self._size >= self.max_size:
+            raise QueueFullError(f"The media queue is full ({self.max_size} jobs).")
+        with self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO media_jobs (user_id, chat_id, update_data, created_at, instance_id) VALUES (?, ?, ?, ?, ?)",
+                (user_id, chat_id, json.dumps(update_data), time.time(), self.instance_id)
+            )
+        job = MediaJob(cursor.lastrowid, user_id, chat_id, update_data)
+        self._enqueue(job)
+        async with self._available:
+            self._available.notify()
+        return job
+
+    def set_status_message(self, job: MediaJob, message_id: int) -> None:
+        job.status_message_id = message_id
+        with self.connection:
+            self.connection.execute("UPDATE media_jobs SET status_message_id = ? WHERE job_id = ?", (message_id, job.job_id))
+
+    def get_position(self, job: MediaJob) -> int:
+        # 1-based number of jobs ahead of an idle worker (including this one), 0 if the job is not waiting
+        # or an idle worker will pick it up right away
+        idle_workers = max(0, len(self._worker_tasks) - self._running)
+        for position, queued_job in enumerate(self._get_order()):
+            if queued_job.job_id == job.job_id:
+                return max(0, position + 1 - idle_workers)
+        return 0
+
+    async def _recover(self) -> int:
+        # queues the jobs of this instance in the database that are neither queued nor running
+        known_ids = set([job.job_id for job in self._get_order()]) | self._running_ids
+        rows = self.connection.execute("SELECT job_id, user_id, chat_id, update_data, status_message_id FROM media_jobs WHERE instance_id = ? ORDER BY job_id", (self.instance_id,)).fetchall()
+        rows = [row for row in rows if row[0] not in known_ids]
+        for job_id, user_id, chat_id, update_data, status_message_id in rows:
+            self._enqueue(MediaJob(job_id, user_id, chat_id, json.loads(update_data), status_message_id, recovered=True))
+        if len(rows) > 0:
+            async with self._available:
+                self._available.notify_all()
+            logger.critical(f"Recovered {len(rows)} queued media job(s).")
+        return len(rows)
+
+    def _send_heartbeat(self) -> None:
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO media_job_instances (instance_id, heartbeat) VALUES (?, ?)", (self.instance_id, time.time()))
+
+    def _claim_orphaned_jobs(self) -> int:
+        # takes over the jobs of instances without a recent heartbeat, in one statement so two replicas cannot both get them
+        with self.connection:
+            cursor = self.connection.execute("""
+                UPDATE media_jobs SET instance_id = ?
+                WHERE instance_id IS NULL OR instance_id NOT IN (SELECT instance_id FROM media_job_instances WHERE heartbeat >= ?)
+            """, (self.instance_id, time.time() - MEDIA_JOB_ORPHAN_TIMEOUT))
+        return cursor.rowcount
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(MEDIA_JOB_HEARTBEAT_INTERVAL)
+            try:
+                self._send_heartbeat()
+                if self._claim_orphaned_jobs() > 0:
+                    await self._recover()
+            except sqlite3.Error as e:
+                logger.critical(f"Media job heartbeat failed: {str(e)}")
+
+    def _get_order(self) -> []:
+        queues = [list(queue) for queue in self._queues.values()]
+        order = []
+        for index in range(max([len(queue) for queue in queues], default=0)):
+            order += [queue[index] for queue in queues if index < len(queue)]
+        return order
+
+    def _enqueue(self, job: MediaJob) -> None:
+        if job.user_id not in self._queues:
+            self._queues[job.user_id] = deque()
+        self._queues[job.user_id].append(job)
+        self._size += 1
+
+    def _dequeue(self) -> MediaJob:
+        user_id, queue = next(iter(self._queues.items()))
+        job = queue.popleft()
+        del self._queues[user_id]
+        if len(queue) > 0: # the user goes to the back of the line
+            self._queues[user_id] = queue
+        self._size -= 1
+        return job
+
+    async def _worker(self) -> None:
+        while True:
+            async with self._available:
+                await self._available.wait_for(lambda: self._size > 0)
+                job = self._dequeue()
+            job.started = True
+            self._running += 1
+            self._running_ids.add(job.job_id)
+            try:
+                await self.handler(job)
+            except Exception as e:
+                logger.critical(f"Media job ({job.job_id}) of user ({job.user_id}) failed: {str(e)}")
+            finally:
+                self._running -= 1
+                self._running_ids.discard(job.job_id)
+            # a cancelled job (shutdown) stays in the database and is recovered on the next start
+            with self.connection:
+                self.connection.execute("DELETE FROM media_jobs WHERE job_id = ?", (job.job_id,))
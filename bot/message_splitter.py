@@ -0,0 +1,133 @@
+import re
+import unicodedata
+
+# Splits long texts into Telegram messages. Telegram limits a message to 4096 UTF-16 code units, so characters outside
+# the Basic Multilingual Plane (most emoji, rare CJK) count twice. A message is cut at the last paragraph break in the
+# second half of the allowed window, else at the last sentence end, else at the last space, else hard (but never inside
+# a grapheme cluster). Formatted texts (parse_mode "HTML", "Markdown" or "MarkdownV2") are only cut outside of tags,
+# entities, links and escapes; formatting still open at the cut is closed and reopened in the next message.
+TELEGRAM_MESSAGE_LIMIT = 4096
+MIN_SEGMENT_RATIO = 0.5 # boundaries in the first half of the window would produce needlessly short messages
+
+_SENTENCE_END = re.compile(r"[.!?…][\"'”’»)\]]*(?=\s)|[。！？]|\n")
+_HTML_UNSAFE = re.compile(r"<[^>]*>?|&[#\w]*;?") # tags and entities
+_HTML_TAG = re.compile(r"<(/?)([a-zA-Z-]+)[^>]*>")
+_MARKDOWN_UNSAFE = re.compile(r"\\.|\[[^\]]*(?:\](?:\([^)]*\)?)?)?") # escapes and links
+_MARKDOWN_TOKENS = {
+    "Markdown": re.compile(r"\\.|```[^\n]*|`|\*|_"),
+    "MarkdownV2": re.compile(r"\\.|```[^\n]*|`|\*|__|_|~|\|\|"),
+}
+
+def get_utf16_length(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+def split_text_fit_message(input_text: str, split_at: int = TELEGRAM_MESSAGE_LIMIT, parse_mode: str = None) -> []:
+    if input_text == None:
+        return []
+    if parse_mode != None and parse_mode not in ["HTML"] + list(_MARKDOWN_TOKENS.keys()):
+        raise ValueError(f"Unsupported parse_mode '{parse_mode}'.")
+    length = len(input_text)
+    segments = []
+    prefix = "" # formatting reopened from the previous segment
+    start = 0
+    while start < length:
+        end = _get_window_end(input_text, start, split_at)
+        if end >= length:
+            segments.append(prefix + input_text[start:])
+            break
+        cut = _get_boundary(input_text, start, end)
+        if parse_mode != None:
+            cut = _get_safe_cut(input_text, start, cut, parse_mode)
+        if cut <= start: # e.g. a window of a single character
+            cut = max(end, start + 1)
+        segment = input_text[start:cut].rstrip()
+        if segment != "":
+            # markup does not count towards the limit, so closing and reopening it needs no room in the window
+            closing, reopening = _get_open_formatting(prefix + segment, parse_mode)
+            segments.append(prefix + segment + closing)
+            prefix = reopening
+        start = cut
+        while start < length and input_text[start].isspace():
+            start += 1
+    return segments
+
+def _get_window_end(text: str, start: int, split_at: int) -> int:
+    # largest end index whose UTF-16 length fits split_at; a surrogate pair cut in half is dropped by the decoder
+    window = text[start:start + split_at].encode("utf-16-le")[:split_at * 2]
+    return start + len(window.decode("utf-16-le", errors="ignore"))
+
+def _get_boundary(text: str, start: int, end: int) -> int:
+    lowest = start + int((end - start) * MIN_SEGMENT_RATIO)
+    paragraph = text.rfind("\n\n", lowest, end)
+    if paragraph != -1:
+        return paragraph
+    sentence = None
+    for match in _SENTENCE_END.finditer(text, lowest, end):
+        sentence = match
+    if sentence != None:
+        return sentence.end()
+    word = max(text.rfind(" ", lowest, end), text.rfind("\t", lowest, end))
+    if word != -1:
+        return word
+    cut = end
+    while cut > start + 1 and _is_grapheme_extension(text, cut):
+        cut -= 1
+    return cut
+
+def _is_grapheme_extension(text: str, index: int) -> bool:
+    # True if text[index] belongs to the same user-perceived character as text[index - 1]
+    char = text[index]
+    return unicodedata.combining(char) != 0 or char in "\u200d\ufe0e\ufe0f" or text[index - 1] == "\u200d" or "\U0001f3fb" <= char <= "\U0001f3ff"
+
+def _get_safe_cut(text: str, start: int, cut: int, parse_mode: str) -> int:
+    pattern = _HTML_UNSAFE if parse_mode == "HTML" else _MARKDOWN_UNSAFE
+    for match in pattern.finditer(text, start, min(len(text), cut + TELEGRAM_MESSAGE_LIMIT)):
+        if match.start() >= cut:
+            break
+        if cut < match.end():
+            # the cut would split this construct, so it moves before it (unless it starts the window)
+            return match.start() if match.start() > start else cut
+    return cut
+
+def _get_open_formatting(segment: str, parse_mode: str) -> []:
+    # returns [closing markup, reopening markup] of the formatting that is still open at the end of the segment
+    if parse_mode == None:
+        return ["", ""]
+    if parse_mode == "HTML":
+        open_tags = []
+        for match in _HTML_TAG.finditer(segment):
+            name = match.group(2).lower()
+            if match.group(1) == "":
+                open_tags.append([name, match.group(0)])
+                continue
+            for index in range(len(open_tags) - 1, -1, -1):
+                if open_tags[index][0] == name:
+                    del open_tags[index]
+                    break
+        closing = "".join([f"</{name}>" for name, tag in reversed(open_tags)])
+        return [closing, "".join([tag for name, tag in open_tags])]
+
+    open_markers = []
+    code_block = None # opening fence including the language, e.g. "```python"
+    inline_code = False
+    for match in _MARKDOWN_TOKENS[parse_mode].finditer(segment):
+        token = match.group(0)
+        if token.startswith("\\"):
+            continue
+        if code_block != None:
+            if token.startswith("```"):
+                code_block = None
+        elif inline_code:
+            if token == "`":
+                inline_code = False
+        elif token.startswith("```"):
+            code_block = token
+        elif token == "`":
+            inline_code = True
+        elif token in open_markers:
+            open_markers.remove(token)
+        else:
+            open_markers.append(token)
+    closing = ("`" if inline_code else "") + ("```" if code_block != None else "") + "".join(reversed(open_markers))
+    reopening = "".join(open_markers) + (code_block + "\n" if code_block != None else "") + ("`" if inline_code else "")
+    return [closing, reopening]
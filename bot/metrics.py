@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+from collections import deque
+from contextvars import ContextVar
+
+# Prometheus-style metrics and lightweight trace spans for the hot paths.
+# With METRICS_PORT set, /metrics (Prometheus text format) and /traces (recent spans as JSON) are served on METRICS_HOST.
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0)) # 0 = disabled
+TRACE_BUFFER_SIZE = 1000
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+logger = logging.getLogger("SST-CHATGPT-TELEGRAM-BOT")
+_registry = []
+_spans = deque(maxlen=TRACE_BUFFER_SIZE)
+_trace_id = ContextVar("trace_id", default=None)
+
+def _format_labels(labels: tuple) -> str:
+    if len(labels) == 0:
+        return ""
+    escaped = [f'{name}="{str(value)}"'.replace("\n", " ") for name, value in labels]
+    return "{" + ",".join(escaped) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(tuple(sorted(labels.items())), 0.0)
+
+    def render(self) -> []:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, documentation: str, callback: object = None):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback # called on every scrape if set
+        self._value = 0.0
+        _registry.append(self)
+
+    def set(self, value: float) -> None:
+        self._value = value
+
+    def render(self) -> []:
+        value = self.callback() if self.callback != None else self._value
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self._values = {} # labels -> [bucket counts..., sum, count]
+        _registry.append(self)
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        if key not in self._values:
+            self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+        values = self._values[key]
+        for index, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                values[index] += 1
+        values[-2] += value
+        values[-1] += 1
+
+    def render(self) -> []:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, values in self._values.items():
+            for index, bucket in enumerate(self.buckets):
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', bucket),))} {values[index]}")
+            lines.append(f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {values[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {values[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {values[-1]}")
+        return lines
+
+
+UPDATES = Counter("bot_updates_total", "Telegram updates received, by type.")
+ERRORS = Counter("bot_errors_total", "Errors that reached the error handler, by type.")
+STAGE_DURATION = Histogram("bot_stage_duration_seconds", "Duration of the processing stages (download, ffmpeg, Whisper, GPT).")
+STAGE_ERRORS = Counter("bot_stage_errors_total", "Failed processing stages.")
+OPENAI_TOKENS = Counter("bot_openai_tokens_total", "ChatGPT tokens, by kind (prompt/completion).")
+WHISPER_AUDIO_SECONDS = Counter("bot_whisper_audio_seconds_total", "Seconds of audio billed by Whisper.")
+CACHE_REQUESTS = Counter("bot_transcription_cache_requests_total", "Transcription cache lookups, by result (hit/miss).")
+MEDIA_QUEUE_DEPTH = Gauge("bot_media_queue_depth", "Media jobs waiting in the queue.")
+MEDIA_JOBS_RUNNING = Gauge("bot_media_jobs_running", "Media jobs currently processed.")
+OPENAI_RETRIES = Counter("bot_openai_retries_total", "Retried OpenAI requests, by API and reason.")
+OPENAI_THROTTLE_SECONDS = Counter("bot_openai_throttle_seconds_total", "Seconds OpenAI requests waited for the rate limit budget, by API.")
+OPENAI_CIRCUIT_OPEN = Counter("bot_openai_circuit_open_total", "Times an OpenAI circuit breaker opened, by API.")
+
+
+def start_trace(trace_id: str = None) -> str:
+    # starts a new trace for the current task; spans opened afterwards in this task (and its subtasks) belong to it
+    trace_id = trace_id if trace_id != None else uuid.uuid4().hex[:16]
+    _trace_id.set(trace_id)
+    return trace_id
+
+def get_trace_id() -> str:
+    return _trace_id.get()
+
+
+class span:
+    # times a stage: with span("whisper", chunk="segment_000.ogg"): ...
+    def __init__(self, stage: str, **attributes):
+        self.stage = stage
+        self.attributes = attributes
+
+    def __enter__(self) -> object:
+        self.start = time.time()
+        self.perf_start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback) -> bool:
+        duration = time.perf_counter() - self.perf_start
+        STAGE_DURATION.observe(duration, stage=self.stage)
+        if exc_type != None and not issubclass(exc_type, asyncio.CancelledError):
+            STAGE_ERRORS.inc(stage=self.stage)
+        _spans.append({
+            "trace_id": get_trace_id(),
+            "stage": self.stage,
+            "start": self.start,
+            "duration": round(duration, 4),
+            "error": exc_type.__name__ if exc_type != None else None,
+            **self.attributes
+        })
+        return False
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in _registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+def get_recent_spans(trace_id: str = None) -> []:
+    return [recorded for recorded in _spans if trace_id == None or recorded["trace_id"] == trace_id]
+
+async def _handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = (await reader.readline()).decode(errors="ignore").split(" ")
+        while (await reader.readline()) not in [b"\r\n", b"\n", b""]: # skip the headers
+            pass
+        path = request_line[1] if len(request_line) > 1 else "/"
+        if path == "/metrics":
+            status, content_type, body = "200 OK", "text/plain; version=0.0.4", render_metrics()
+        elif path.startswith("/traces"):
+            trace_id = path.split("trace_id=")[1] if "trace_id=" in path else None
+            status, content_type, body = "200 OK", "application/json", json.dumps(get_recent_spans(trace_id))
+        else:
+            status, content_type, body = "404 Not Found", "text/plain", "Not Found\n"
+        body = body.encode()
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT) -> object:
+    if port == 0:
+        return None
+    server = await asyncio.start_server(_handle_request, host, port)
+    logger.critical(f"Metrics are served on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,91 @@
+import os
+import asyncio
+import aiohttp
+import openai
+from helpers import ModelType
+from chat_context import count_tokens, count_message_tokens
+from openai_scheduler import RequestScheduler, GPT_RPM_LIMIT, GPT_TPM_LIMIT, WHISPER_RPM_LIMIT
+
+# Shared async transport for all OpenAI calls: one pooled HTTP session per process,
+# per-call timeouts (in seconds) and a cap on how many requests of each kind run at once.
+# Rate limits, retries and the circuit breaker are handled by openai_scheduler.
+OPENAI_MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONNECTIONS", 20))
+GPT_MAX_CONCURRENCY = int(os.environ.get("GPT_MAX_CONCURRENCY", 8))
+WHISPER_MAX_CONCURRENCY = int(os.environ.get("WHISPER_MAX_CONCURRENCY", 4))
+GPT_REQUEST_TIMEOUT = float(os.environ.get("GPT_REQUEST_TIMEOUT", 120))
+WHISPER_REQUEST_TIMEOUT = float(os.environ.get("WHISPER_REQUEST_TIMEOUT", 120)) # plus WHISPER_TIMEOUT_PER_MB for every MB uploaded
+WHISPER_TIMEOUT_PER_MB = float(os.environ.get("WHISPER_TIMEOUT_PER_MB", 30)) # one MB is about three minutes of speech at 48 kbit/s
+GPT_COMPLETION_TOKEN_ESTIMATE = 500 # reserved for the reply until its real length is known
+
+_session = None
+_gpt_semaphore = asyncio.Semaphore(GPT_MAX_CONCURRENCY)
+_whisper_semaphore = asyncio.Semaphore(WHISPER_MAX_CONCURRENCY)
+gpt_scheduler = RequestScheduler("chat", GPT_RPM_LIMIT, GPT_TPM_LIMIT)
+whisper_scheduler = RequestScheduler("whisper", WHISPER_RPM_LIMIT, retry_timeouts=False) # a timed out upload would most likely time out again
+
+def get_session() -> aiohttp.ClientSession:
+    global _session
+    if _session == None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=OPENAI_MAX_CONNECTIONS, keepalive_timeout=60)
+        )
+    # openai keeps the session in a ContextVar, so it has to be set in the calling task's context
+    openai.aiosession.set(_session)
+    return _session
+
+async def close_session(*args) -> None:
+    global _session
+    if _session != None and not _session.closed:
+        await _session.close()
+    _session = None
+
+def estimate_chat_tokens(messages: list, model: str) -> int:
+    return sum([count_message_tokens(message, model) for message in messages]) + GPT_COMPLETION_TOKEN_ESTIMATE
+
+async def create_chat_completion(messages: list, model: str = ModelType.GPT35.value) -> object:
+    get_session()
+    estimated_tokens = estimate_chat_tokens(messages, model)
+    async with _gpt_semaphore:
+        completion = await gpt_scheduler.run(
+            lambda: asyncio.wait_for(openai.ChatCompletion.acreate(model=model, messages=messages), timeout=GPT_REQUEST_TIMEOUT),
+            estimated_tokens
+        )
+    gpt_scheduler.record_tokens(estimated_tokens, completion["usage"]["total_tokens"])
+    return completion
+
+async def stream_chat_completion(messages: list, model: str = ModelType.GPT35.value) -> object:
+    # yields the content deltas of the reply as they arrive
+    # only opening the stream is retried, a reply that already started is not repeated
+    get_session()
+    estimated_tokens = estimate_chat_tokens(messages, model)
+    reply = ""
+    async with _gpt_semaphore:
+        response = await gpt_scheduler.run(
+            lambda: asyncio.wait_for(openai.ChatCompletion.acreate(model=model, messages=messages, stream=True), timeout=GPT_REQUEST_TIMEOUT),
+            estimated_tokens
+        )
+        try:
+            async for chunk in response:
+                delta = chunk.choices[0].get("delta", {})
+                if "content" in delta:
+                    reply += delta["content"]
+                    yield delta["content"]
+        finally:
+            used_tokens = estimated_tokens - GPT_COMPLETION_TOKEN_ESTIMATE + count_tokens(reply, model)
+            gpt_scheduler.record_tokens(estimated_tokens, used_tokens)
+
+async def create_transcription(f: object, language: str = "auto") -> object:
+    get_session()
+    params = {"response_format": "verbose_json"} # verbose_json, srt, vtt, text
+    if language != "auto":
+        params["language"] = language
+    # longer parts take longer to upload and to transcribe
+    timeout = WHISPER_REQUEST_TIMEOUT + WHISPER_TIMEOUT_PER_MB * os.fstat(f.fileno()).st_size / (1024 * 1024)
+    async def request() -> object:
+        f.seek(0) # a retry has to upload the file from the start again
+        return await asyncio.wait_for(
+            openai.Audio.atranscribe(model=ModelType.WHISPER.value, file=f, **params),
+            timeout=timeout
+        )
+    async with _whisper_semaphore:
+        return await whisper_scheduler.run(request)
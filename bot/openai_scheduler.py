@@ -0,0 +1,194 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import openai
+from metrics import OPENAI_RETRIES, OPENAI_THROTTLE_SECONDS, OPENAI_CIRCUIT_OPEN
+
+# Client-side rate limiting for the OpenAI API: requests and tokens per minute are budgeted with token buckets,
+# so calls wait for their share instead of bursting into 429s. Rate limits and server errors are retried with
+# jittered exponential backoff; after OPENAI_CIRCUIT_FAILURES consecutive requests failed with server errors (each
+# request counts once, however often it was retried) the circuit opens and further calls fail fast for
+# OPENAI_CIRCUIT_RESET_TIME seconds before a single trial request is let through. A request that ran into our own
+# timeout is only retried if the scheduler allows it, and never counts as an outage: it may just be a large upload.
+GPT_RPM_LIMIT = int(os.environ.get("GPT_RPM_LIMIT", 3500))
+GPT_TPM_LIMIT = int(os.environ.get("GPT_TPM_LIMIT", 90000))
+WHISPER_RPM_LIMIT = int(os.environ.get("WHISPER_RPM_LIMIT", 50))
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", 5))
+OPENAI_BACKOFF_BASE = 1.0 # seconds
+OPENAI_BACKOFF_MAX = 60.0 # seconds
+OPENAI_CIRCUIT_FAILURES = int(os.environ.get("OPENAI_CIRCUIT_FAILURES", 5))
+OPENAI_CIRCUIT_RESET_TIME = float(os.environ.get("OPENAI_CIRCUIT_RESET_TIME", 30)) # seconds
+
+logger = logging.getLogger("SST-CHATGPT-TELEGRAM-BOT")
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class TokenBucket:
+    # refills `per_minute` tokens per minute up to `burst` (default: one minute's worth); waiters are served in arrival order
+    def __init__(self, per_minute: float, burst: float = None):
+        self.capacity = float(burst if burst != None else per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float = 1.0) -> float:
+        # returns the seconds waited
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        async with self._lock:
+            self._refill()
+            while self.tokens < amount:
+                delay = (amount - self.tokens) / self.rate
+                await asyncio.sleep(delay)
+                waited += delay
+                self._refill()
+            self.tokens -= amount
+        return waited
+
+    def adjust(self, amount: float) -> None:
+        # corrects an estimate once the real usage is known; the balance may go negative (debt)
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+    def pause(self, seconds: float) -> None:
+        # empties the bucket for `seconds`, e.g. after the server sent Retry-After
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int = OPENAI_CIRCUIT_FAILURES, reset_time: float = OPENAI_CIRCUIT_RESET_TIME):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_time = reset_time
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+
+    def before_request(self) -> None:
+        if self.opened_at == None:
+            return
+        if time.monotonic() - self.opened_at < self.reset_time or self._trial_running:
+            raise CircuitOpenError(f"The OpenAI {self.name} API is currently unavailable. Please try again later.")
+        self._trial_running = True # half-open: let a single request through
+
+    def record_success(self) -> None:
+        if self.opened_at != None:
+            logger.warning(f"OpenAI {self.name} circuit closed again.")
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+
+    def abort_request(self) -> None:
+        # the request was cancelled without a result, so a trial request has to be repeated
+        self._trial_running = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._trial_running = False
+        if self.opened_at != None or self.failures >= self.failure_threshold:
+            if self.opened_at == None:
+                OPENAI_CIRCUIT_OPEN.inc(api=self.name)
+                logger.critical(f"OpenAI {self.name} circuit opened after {self.failures} failed requests.")
+            self.opened_at = time.monotonic()
+
+
+def get_retry_reason(e: Exception) -> str:
+    # returns why a failed request may be retried, None if retrying would not help
+    if isinstance(e, openai.error.RateLimitError):
+        if e.code == "insufficient_quota": # the account is out of credit, waiting does not change that
+            return None
+        return "rate_limit"
+    if isinstance(e, asyncio.TimeoutError): # our own timeout, not an answer of the API
+        return "timeout"
+    if isinstance(e, (openai.error.ServiceUnavailableError, openai.error.APIConnectionError, openai.error.Timeout, openai.error.TryAgain)):
+        return "unavailable"
+    if isinstance(e, openai.error.APIError) and e.http_status != None and e.http_status >= 500:
+        return "server_error"
+    return None
+
+def get_retry_after(e: Exception) -> float:
+    headers = getattr(e, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class RequestScheduler:
+    def __init__(self, name: str, rpm_limit: int, tpm_limit: int = None, max_retries: int = OPENAI_MAX_RETRIES, retry_timeouts: bool = True):
+        self.name = name
+        self.requests = TokenBucket(rpm_limit)
+        self.tokens = TokenBucket(tpm_limit) if tpm_limit else None
+        self.circuit = CircuitBreaker(name)
+        self.max_retries = max_retries
+        self.retry_timeouts = retry_timeouts
+
+    async def run(self, request: object, estimated_tokens: int = 0) -> object:
+        # `request` is a coroutine function without arguments, called once per attempt
+        attempt = 0
+        last_error = None
+        failure_recorded = False
+        while True:
+            try:
+                self.circuit.before_request()
+            except CircuitOpenError:
+                if last_error != None: # the circuit opened while this request was retried, its own error is more telling
+                    raise last_error
+                raise
+            waited = await self.requests.acquire()
+            if self.tokens != None:
+                waited += await self.tokens.acquire(estimated_tokens)
+            if waited > 0:
+                OPENAI_THROTTLE_SECONDS.inc(waited, api=self.name)
+            try:
+                result = await request()
+            except asyncio.CancelledError:
+                self.circuit.abort_request()
+                raise
+            except Exception as e:
+                last_error = e
+                reason = get_retry_reason(e)
+                if reason == "timeout":
+                    # neither a success nor an outage, but a half-open circuit needs another trial request
+                    self.circuit.abort_request()
+                    if not self.retry_timeouts:
+                        reason = None
+                elif reason in ["unavailable", "server_error"]:
+                    # a failed trial request always reopens the circuit
+                    if not failure_recorded or self.circuit.opened_at != None:
+                        self.circuit.record_failure()
+                    failure_recorded = True
+                else: # the API answered, it is just not accepting this request (yet)
+                    self.circuit.record_success()
+                if reason == None or attempt >= self.max_retries:
+                    raise
+                delay = min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** attempt)
+                delay = random.uniform(delay / 2, delay) # jitter, so parallel requests do not retry in lockstep
+                retry_after = get_retry_after(e)
+                if retry_after != None:
+                    delay = max(delay, retry_after)
+                attempt += 1
+                OPENAI_RETRIES.inc(api=self.name, reason=reason)
+                logger.warning(f"OpenAI {self.name} request failed ({reason}), retry {attempt}/{self.max_retries} in {delay:.1f}s: {str(e)}")
+                if reason == "rate_limit": # holds back all requests of this API, including the retry
+                    self.requests.pause(delay)
+                else:
+                    await asyncio.sleep(delay)
+                continue
+            self.circuit.record_success()
+            return result
+
+    def record_tokens(self, estimated_tokens: int, used_tokens: int) -> None:
+        if self.tokens != None:
+            self.tokens.adjust(used_tokens - estimated_tokens)
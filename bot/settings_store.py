@@ -0,0 +1,216 @@
+import os
+import time
+import json
+import sqlite3
+import logging
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+from helpers import get_current_month
+
+# Bot settings, access lists and usage cost in one SQLite database (WAL mode, so several writers can share it).
+# Settings and access lists are cached and reloaded when another connection (e.g. another bot replica) committed a
+# change, detected with PRAGMA data_version. Usage cost is added to the monthly totals in batches with atomic
+# increments, and totals and password attempts are always read from the database.
+SETTINGS_DB_FILE = os.environ.get("SETTINGS_DB_FILE", "sttchatgpttelegrambot.db")
+USAGE_FLUSH_INTERVAL = float(os.environ.get("USAGE_FLUSH_INTERVAL", 10)) # seconds
+UPDATE_DEDUP_TTL = 24 * 3600 # seconds an update_id is remembered; Telegram stops redelivering long before
+UPDATE_DEDUP_PRUNE_INTERVAL = 1000 # claimed updates between two prunes of the table
+LEGACY_SETTINGS_APP_ID = "contentcrow.sttchatgpttelegrambot"
+
+logger = logging.getLogger("SST-CHATGPT-TELEGRAM-BOT")
+
+DEFAULT_SETTINGS = {
+    "language": "auto",
+    "speed": 1.2,
+}
+
+class SettingsStore:
+    def __init__(self, path: str = SETTINGS_DB_FILE, flush_interval: float = USAGE_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS settings (
+                name TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS access (
+                user_id INTEGER PRIMARY KEY,
+                status TEXT NOT NULL CHECK (status IN ('whitelisted', 'blacklisted'))
+            );
+            CREATE TABLE IF NOT EXISTS password_attempts (
+                user_id INTEGER PRIMARY KEY,
+                count INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS usage_cost (
+                month TEXT PRIMARY KEY,
+                cost REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS processed_updates (
+                update_id INTEGER PRIMARY KEY,
+                created_at REAL NOT NULL
+            );
+        """)
+        self.connection.commit()
+        self._pending_usage = {} # month -> cost not yet added to usage_cost
+        self._last_flush = time.monotonic()
+        self._claimed_updates = 0
+        self._data_version = None
+        self.load()
+
+    def load(self) -> None:
+        self._data_version = self.connection.execute("PRAGMA data_version").fetchone()[0]
+        self._settings = dict(DEFAULT_SETTINGS)
+        for name, value in self.connection.execute("SELECT name, value FROM settings"):
+            self._settings[name] = json.loads(value)
+        self._whitelisted_ids = set()
+        self._blacklisted_ids = set()
+        for user_id, status in self.connection.execute("SELECT user_id, status FROM access"):
+            (self._whitelisted_ids if status == "whitelisted" else self._blacklisted_ids).add(user_id)
+
+    def refresh(self) -> None:
+        # reloads the cached settings if another connection has committed since they were read
+        if self.connection.execute("PRAGMA data_version").fetchone()[0] != self._data_version:
+            self.load()
+
+    def __str__(self) -> str:
+        return f"language={self.language}, speed={self.speed}, whitelisted_ids={sorted(self.whitelisted_ids)}, blacklisted_ids={sorted(self.blacklisted_ids)}"
+
+    @property
+    def whitelisted_ids(self) -> set:
+        self.refresh()
+        return self._whitelisted_ids
+
+    @property
+    def blacklisted_ids(self) -> set:
+        self.refresh()
+        return self._blacklisted_ids
+
+    @property
+    def language(self) -> str:
+        self.refresh()
+        return self._settings["language"]
+
+    @language.setter
+    def language(self, value: str) -> None:
+        self._set_setting("language", value)
+
+    @property
+    def speed(self) -> float:
+        self.refresh()
+        return self._settings["speed"]
+
+    @speed.setter
+    def speed(self, value: float) -> None:
+        self._set_setting("speed", value)
+
+    def add_whitelisted_id(self, user_id: int) -> None:
+        self._set_access(int(user_id), "whitelisted")
+        self._blacklisted_ids.discard(int(user_id))
+        self._whitelisted_ids.add(int(user_id))
+
+    def add_blacklisted_id(self, user_id: int) -> None:
+        self._set_access(int(user_id), "blacklisted")
+        self._whitelisted_ids.discard(int(user_id))
+        self._blacklisted_ids.add(int(user_id))
+
+    def get_password_attempts(self, user_id: int) -> int:
+        row = self.connection.execute("SELECT count FROM password_attempts WHERE user_id = ?", (int(user_id),)).fetchone()
+        return row[0] if row != None else 0
+
+    def add_password_attempt(self, user_id: int) -> int:
+        # returns the number of failed attempts including this one, counted across all bot instances
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO password_attempts (user_id, count) VALUES (?, 1) ON CONFLICT (user_id) DO UPDATE SET count = count + 1",
+                (int(user_id),)
+            )
+            return self.connection.execute("SELECT count FROM password_attempts WHERE user_id = ?", (int(user_id),)).fetchone()[0]
+
+    def add_usage_cost(self, cost: float, month: str = None) -> float:
+        month = month if month != None else get_current_month()
+        self._pending_usage[month] = self._pending_usage.get(month, 0.0) + cost
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+        return self.get_usage_cost(month)
+
+    def get_usage_cost(self, month: str = None) -> float:
+        # total of all replicas plus the cost of this one that is not flushed yet
+        month = month if month != None else get_current_month()
+        row = self.connection.execute("SELECT cost FROM usage_cost WHERE month = ?", (month,)).fetchone()
+        return (row[0] if row != None else 0.0) + self._pending_usage.get(month, 0.0)
+
+    def flush(self) -> None:
+        self._last_flush = time.monotonic()
+        if len(self._pending_usage) == 0:
+            return
+        pending_usage = self._pending_usage
+        self._pending_usage = {}
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO usage_cost (month, cost) VALUES (?, ?) ON CONFLICT (month) DO UPDATE SET cost = cost + excluded.cost",
+                list(pending_usage.items())
+            )
+
+    def claim_update(self, update_id: int) -> bool:
+        # True for the first bot instance that sees this update, False for redeliveries
+        with self.connection:
+            cursor = self.connection.execute("INSERT OR IGNORE INTO processed_updates (update_id, created_at) VALUES (?, ?)", (update_id, time.time()))
+            self._claimed_updates += 1
+            if self._claimed_updates % UPDATE_DEDUP_PRUNE_INTERVAL == 0:
+                self.connection.execute("DELETE FROM processed_updates WHERE created_at < ?", (time.time() - UPDATE_DEDUP_TTL,))
+        return cursor.rowcount == 1
+
+    def close(self) -> None:
+        self.flush()
+        self.connection.close()
+
+    def is_empty(self) -> bool:
+        for table in ["settings", "access", "usage_cost"]:
+            if self.connection.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() != None:
+                return False
+        return True
+
+    def migrate_legacy_settings(self) -> bool:
+        # one-time import of the settings file written by the usersettings package in earlier versions
+        if not self.is_empty():
+            return False
+        try:
+            import usersettings
+        except ImportError:
+            return False
+        legacy = usersettings.Settings(LEGACY_SETTINGS_APP_ID)
+        legacy.add_setting("language", str, default="auto")
+        legacy.add_setting("speed", float, default=1.2)
+        legacy.add_setting("whitelisted_ids", list, default=[])
+        legacy.add_setting("blacklisted_ids", list, default=[])
+        legacy.add_setting("usage_cost", list, default=[])
+        legacy.add_setting("index_zero_date", default=get_current_month())
+        legacy.load_settings()
+        index_zero_date = datetime.strptime(legacy.index_zero_date, "%Y-%m")
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)", [
+                ["language", json.dumps(legacy.language)],
+                ["speed", json.dumps(legacy.speed)]
+            ])
+            self.connection.executemany("INSERT OR REPLACE INTO access (user_id, status) VALUES (?, 'whitelisted')", [[int(user_id)] for user_id in legacy.whitelisted_ids])
+            self.connection.executemany("INSERT OR REPLACE INTO access (user_id, status) VALUES (?, 'blacklisted')", [[int(user_id)] for user_id in legacy.blacklisted_ids])
+            self.connection.executemany("INSERT INTO usage_cost (month, cost) VALUES (?, ?)", [
+                [(index_zero_date + relativedelta(months=index)).strftime("%Y-%m"), cost]
+                for index, cost in enumerate(legacy.usage_cost) if cost > 0.0
+            ])
+        self.load()
+        logger.critical(f"Migrated usersettings ({LEGACY_SETTINGS_APP_ID}) to {self.path}.")
+        return True
+
+    def _set_setting(self, name: str, value: object) -> None:
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)", (name, json.dumps(value)))
+        self._settings[name] = value
+
+    def _set_access(self, user_id: int, status: str) -> None:
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO access (user_id, status) VALUES (?, ?)", (user_id, status))
+            self.connection.execute("DELETE FROM password_attempts WHERE user_id = ?", (user_id,))
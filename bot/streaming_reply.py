@@ -0,0 +1,64 @@
+import os
+import time
+import asyncio
+from telegram.error import BadRequest, RetryAfter
+from message_splitter import split_text_fit_message, get_utf16_length, TELEGRAM_MESSAGE_LIMIT
+
+# minimum seconds between two edits of the same message (Telegram allows roughly one edit per second and chat)
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", 1.0))
+
+class StreamingReply:
+    # Shows a reply while it is generated by editing a message in place.
+    # Full messages are rolled over to a new message once the Telegram length limit is reached.
+    def __init__(self, bot: object, chat_id: int, message: object = None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message = message # message currently edited, None if the next flush sends a new one
+        self.text = "" # text of the current message
+        self.sent_text = None
+        self.next_edit = 0.0
+
+    async def append(self, delta: str) -> None:
+        if not delta:
+            return
+        self.text += delta
+        if len(self.text) >= TELEGRAM_MESSAGE_LIMIT // 2 and get_utf16_length(self.text) >= TELEGRAM_MESSAGE_LIMIT:
+            await self.roll_over()
+        if time.monotonic() >= self.next_edit:
+            await self.flush()
+
+    async def roll_over(self) -> None:
+        segments = split_text_fit_message(self.text)
+        for segment in segments[:-1]:
+            self.text = segment
+            await self.flush(force=True)
+            self.message = None
+            self.sent_text = None
+        self.text = segments[-1] if len(segments) > 0 else ""
+
+    async def finish(self) -> None:
+        await self.flush(force=True)
+
+    async def flush(self, force: bool = False) -> None:
+        if self.text.strip() == "" or self.text == self.sent_text:
+            return
+        # intermediate edits are not worth waiting for when Telegram throttles, so the rate limiter must not retry them
+        rate_limit_args = None if force else {"max_retries": 0}
+        while True:
+            try:
+                if self.message == None:
+                    self.message = await self.bot.send_message(chat_id=self.chat_id, text=self.text, rate_limit_args=rate_limit_args)
+                else:
+                    await self.bot.edit_message_text(chat_id=self.chat_id, message_id=self.message.message_id, text=self.text, rate_limit_args=rate_limit_args)
+                break
+            except RetryAfter as e:
+                if not force: # skip this edit, one of the next ones will catch up
+                    self.next_edit = time.monotonic() + e.retry_after
+                    return
+                await asyncio.sleep(e.retry_after)
+            except BadRequest as e:
+                if "not modified" in str(e):
+                    break
+                raise
+        self.sent_text = self.text
+        self.next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
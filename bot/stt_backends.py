@@ -0,0 +1,104 @@
+import os
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from helpers import get_final_file_size, calculateCostByDuration
+from encoding_planner import WHISPER_API_FILE_SIZE_LIMIT
+from openai_client import create_transcription
+
+# Speech-to-text backends: the OpenAI Whisper API or a local CPU engine (faster-whisper / CTranslate2, int8).
+# STT_BACKEND selects the backend per deployment: "api", "local" or "auto" (local for files up to
+# LOCAL_WHISPER_MAX_DURATION seconds, API for longer ones).
+STT_BACKEND = os.environ.get("STT_BACKEND", "api").lower()
+LOCAL_WHISPER_MODEL = os.environ.get("LOCAL_WHISPER_MODEL", "small")
+LOCAL_WHISPER_COMPUTE_TYPE = os.environ.get("LOCAL_WHISPER_COMPUTE_TYPE", "int8")
+LOCAL_WHISPER_WORKERS = int(os.environ.get("LOCAL_WHISPER_WORKERS", 1))
+LOCAL_WHISPER_THREADS = int(os.environ.get("LOCAL_WHISPER_THREADS", 4)) # CPU threads per worker process
+LOCAL_WHISPER_BEAM_SIZE = 5
+LOCAL_WHISPER_MAX_DURATION = float(os.environ.get("LOCAL_WHISPER_MAX_DURATION", 600)) # seconds, only used by "auto"
+
+_local_model = None # faster-whisper model of a pool worker process
+
+class SttBackend:
+    name = None
+
+    async def transcribe(self, file_name: str, language: str = "auto") -> dict:
+        # returns {"text": str, "duration": float, "cost": float, "segments": [{"start": s, "end": s, "text": str}, ...]}
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+
+class WhisperApiBackend(SttBackend):
+    name = "api"
+
+    async def transcribe(self, file_name: str, language: str = "auto") -> dict:
+        with open(file_name, "rb") as f:
+            if get_final_file_size(f) > WHISPER_API_FILE_SIZE_LIMIT:
+                raise Exception(f"Audio part '{os.path.basename(file_name)}' exceeds the Whisper API file size limit of {WHISPER_API_FILE_SIZE_LIMIT} MB.")
+            transcript_obj = await create_transcription(f, language)
+        duration = transcript_obj["duration"]
+        segments = [{"start": segment["start"], "end": segment["end"], "text": segment["text"].strip()} for segment in transcript_obj.get("segments", [])]
+        return {"text": transcript_obj["text"], "duration": duration, "cost": calculateCostByDuration(duration), "segments": segments}
+
+
+def _init_local_worker(model: str, compute_type: str, threads: int) -> None:
+    # runs once per pool process, so the model is loaded only once per worker
+    global _local_model
+    from faster_whisper import WhisperModel
+    _local_model = WhisperModel(model, device="cpu", compute_type=compute_type, cpu_threads=threads)
+
+def _transcribe_local(file_name: str, language: str) -> dict:
+    segments, info = _local_model.transcribe(file_name, language=None if language == "auto" else language, beam_size=LOCAL_WHISPER_BEAM_SIZE)
+    segments = [{"start": segment.start, "end": segment.end, "text": segment.text.strip()} for segment in segments]
+    text = " ".join([segment["text"] for segment in segments])
+    return {"text": text, "duration": info.duration, "cost": 0.0, "segments": segments}
+
+
+class LocalWhisperBackend(SttBackend):
+    name = "local"
+
+    def __init__(self, model: str = LOCAL_WHISPER_MODEL, compute_type: str = LOCAL_WHISPER_COMPUTE_TYPE, workers: int = LOCAL_WHISPER_WORKERS, threads: int = LOCAL_WHISPER_THREADS):
+        try:
+            import faster_whisper
+        except ImportError:
+            raise Exception("The local STT backend needs the faster-whisper package: pip install faster-whisper")
+        # spawn instead of fork: the bot process runs threads (event loop, SQLite) which must not be copied
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_local_worker,
+            initargs=(model, compute_type, threads)
+        )
+
+    async def transcribe(self, file_name: str, language: str = "auto") -> dict:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, _transcribe_local, file_name, language)
+
+    async def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class SttBackendSelector:
+    def __init__(self, mode: str = STT_BACKEND, max_local_duration: float = LOCAL_WHISPER_MAX_DURATION):
+        if mode not in ["api", "local", "auto"]:
+            raise Exception(f"Unknown STT_BACKEND '{mode}', use 'api', 'local' or 'auto'.")
+        self.mode = mode
+        self.max_local_duration = max_local_duration
+        self.api = WhisperApiBackend()
+        self.local = LocalWhisperBackend() if mode != "api" else None
+
+    def get_backend(self, duration: float = None) -> SttBackend:
+        # duration of the file in seconds, None if unknown
+        if self.mode == "api":
+            return self.api
+        if self.mode == "local":
+            return self.local
+        if duration != None and duration <= self.max_local_duration:
+            return self.local
+        return self.api
+
+    async def close(self) -> None:
+        await self.api.close()
+        if self.local != None:
+            await self.local.close()
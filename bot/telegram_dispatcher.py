@@ -0,0 +1,91 @@
+import os
+import logging
+from collections import OrderedDict
+from telegram.error import RetryAfter, BadRequest
+from telegram.ext import BaseRateLimiter
+from message_splitter import split_text_fit_message
+from openai_scheduler import TokenBucket
+
+# Outgoing Telegram traffic is paced to the Bot API flood limits: about one message per second in a chat,
+# 20 per minute in a group and 30 per second overall. Requests wait for their chat's and the global budget,
+# and a RetryAfter from Telegram holds back the chat and retries the request instead of failing the update.
+TELEGRAM_GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", 30)) # messages per second
+TELEGRAM_CHAT_RATE = float(os.environ.get("TELEGRAM_CHAT_RATE", 1)) # messages per second in a private chat
+TELEGRAM_GROUP_RATE = float(os.environ.get("TELEGRAM_GROUP_RATE", 20)) # messages per minute in a group
+TELEGRAM_CHAT_BURST = 3
+TELEGRAM_MAX_RETRIES = int(os.environ.get("TELEGRAM_MAX_RETRIES", 3))
+TELEGRAM_CHAT_BUCKETS = 10000 # chats whose budget is tracked, the least recently active are forgotten
+# transcripts that would need at least this many messages are sent as a .txt document instead (0 = never)
+TRANSCRIPT_DOCUMENT_MIN_MESSAGES = int(os.environ.get("TRANSCRIPT_DOCUMENT_MIN_MESSAGES", 10))
+
+logger = logging.getLogger("SST-CHATGPT-TELEGRAM-BOT")
+
+class ChatRateLimiter(BaseRateLimiter):
+    # rate_limit_args: {"max_retries": n} overrides TELEGRAM_MAX_RETRIES for a single request
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_RATE, chat_rate: float = TELEGRAM_CHAT_RATE, group_rate: float = TELEGRAM_GROUP_RATE, max_retries: int = TELEGRAM_MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate * 60, burst=global_rate)
+        self.chat_rate = chat_rate * 60
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._chat_buckets = OrderedDict()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def get_chat_bucket(self, chat_id: object) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket == None:
+            is_group = str(chat_id).startswith("-") or str(chat_id).startswith("@") # groups and channels
+            bucket = TokenBucket(self.group_rate if is_group else self.chat_rate, burst=TELEGRAM_CHAT_BURST)
+            self._chat_buckets[chat_id] = bucket
+            while len(self._chat_buckets) > TELEGRAM_CHAT_BUCKETS:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def process_request(self, callback: object, args: object, kwargs: dict, endpoint: str, data: dict, rate_limit_args: dict) -> object:
+        chat_id = data.get("chat_id")
+        if chat_id == None: # getUpdates, getFile, setWebhook, ...
+            return await callback(*args, **kwargs)
+        max_retries = (rate_limit_args or {}).get("max_retries", self.max_retries)
+        chat_bucket = self.get_chat_bucket(chat_id)
+        attempt = 0
+        while True:
+            await chat_bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= max_retries:
+                    raise
+                attempt += 1
+                logger.warning(f"Telegram flood limit in chat {chat_id} ({endpoint}), retry {attempt}/{max_retries} in {e.retry_after}s.")
+                chat_bucket.pause(e.retry_after)
+
+
+async def send_text(bot: object, chat_id: int, text: str, status_message_id: int = None, document_name: str = None) -> bool:
+    # Sends a long text in as few messages as possible. The status message (e.g. "🤔💬") is edited into the first
+    # part instead of being deleted and followed by a new message. With document_name, texts that would need at
+    # least TRANSCRIPT_DOCUMENT_MIN_MESSAGES messages are sent as a single .txt document.
+    # Returns True if the status message was reused.
+    segments = split_text_fit_message(text)
+    if len(segments) == 0:
+        return False
+    if document_name != None and TRANSCRIPT_DOCUMENT_MIN_MESSAGES > 0 and len(segments) >= TRANSCRIPT_DOCUMENT_MIN_MESSAGES:
+        await bot.send_document(chat_id=chat_id, document=text.encode("utf-8"), filename=document_name)
+        return False
+    reused = False
+    if status_message_id != None:
+        try:
+            await bot.edit_message_text(chat_id=chat_id, message_id=status_message_id, text=segments[0])
+            segments = segments[1:]
+            reused = True
+        except BadRequest: # deleted by the user
+            pass
+    for segment in segments:
+        await bot.send_message(chat_id=chat_id, text=segment)
+    return reused
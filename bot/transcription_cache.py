@@ -0,0 +1,93 @@
+import os
+import time
+import sqlite3
+import logging
+
+# Persistent cache of finished transcriptions, keyed on Telegram's file_unique_id plus language, speed,
+# STT backend and silence trimming.
+# Least recently used entries are evicted once the stored transcripts exceed TRANSCRIPTION_CACHE_MAX_MB.
+TRANSCRIPTION_CACHE_FILE = os.environ.get("TRANSCRIPTION_CACHE_FILE", "transcription_cache.db")
+TRANSCRIPTION_CACHE_MAX_MB = float(os.environ.get("TRANSCRIPTION_CACHE_MAX_MB", 50))
+
+logger = logging.getLogger("SST-CHATGPT-TELEGRAM-BOT")
+
+def get_cache_key(file_unique_id: str, language: str, speed: float, backend: str = "api", silence_trimming: bool = False) -> str:
+    cache_key = f"{file_unique_id}:{language}:{speed}"
+    if backend != "api": # transcripts of other backends differ and did not cost the same
+        cache_key += f":{backend}"
+    if silence_trimming: # trimmed audio can lose words at the cuts
+        cache_key += ":trimmed"
+    return cache_key
+
+
+class TranscriptionCache:
+    def __init__(self, path: str = TRANSCRIPTION_CACHE_FILE, max_mb: float = TRANSCRIPTION_CACHE_MAX_MB):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS transcripts (
+                cache_key TEXT PRIMARY KEY,
+                transcript TEXT NOT NULL,
+                cost REAL NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS transcripts_last_used ON transcripts (last_used);
+            CREATE TABLE IF NOT EXISTS stats (
+                name TEXT PRIMARY KEY,
+                value REAL NOT NULL
+            );
+        """)
+        self.connection.commit()
+
+    def get(self, cache_key: str) -> str:
+        row = self.connection.execute("SELECT transcript, cost FROM transcripts WHERE cache_key = ?", (cache_key,)).fetchone()
+        if row == None:
+            self._add_stat("misses", 1)
+            self.connection.commit()
+            return None
+        self.connection.execute("UPDATE transcripts SET last_used = ? WHERE cache_key = ?", (time.time(), cache_key))
+        self._add_stat("hits", 1)
+        self._add_stat("saved_cost", row[1])
+        self.connection.commit()
+        return row[0]
+
+    def put(self, cache_key: str, transcript: str, cost: float) -> None:
+        size = len(transcript.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        self.connection.execute(
+            "INSERT OR REPLACE INTO transcripts (cache_key, transcript, cost, size, last_used) VALUES (?, ?, ?, ?, ?)",
+            (cache_key, transcript, cost, size, time.time())
+        )
+        self.evict()
+        self.connection.commit()
+
+    def evict(self) -> int:
+        total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM transcripts").fetchone()[0]
+        evicted = 0
+        if total_size <= self.max_bytes:
+            return evicted
+        for cache_key, size in self.connection.execute("SELECT cache_key, size FROM transcripts ORDER BY last_used").fetchall():
+            self.connection.execute("DELETE FROM transcripts WHERE cache_key = ?", (cache_key,))
+            total_size -= size
+            evicted += 1
+            if total_size <= self.max_bytes:
+                break
+        return evicted
+
+    def get_stats(self) -> dict:
+        stats = {"hits": 0, "misses": 0, "saved_cost": 0.0}
+        for name, value in self.connection.execute("SELECT name, value FROM stats"):
+            stats[name] = value
+        stats["entries"] = self.connection.execute("SELECT COUNT(*) FROM transcripts").fetchone()[0]
+        return stats
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def _add_stat(self, name: str, value: float) -> None:
+        self.connection.execute(
+            "INSERT INTO stats (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, value)
+        )